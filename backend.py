@@ -0,0 +1,197 @@
+# ==============================================================================
+# === PIPEWIRE BACKENDS ===
+# ==============================================================================
+# Everything the switcher needs from PipeWire goes through one of these:
+#   - graph / nodes():  live node table (same shape as pw-dump objects)
+#   - start(on_change): begin watching, on_change(changes) on every update
+#   - read_formats():   negotiated rate/format of streams that hide them
+#   - set_clock():      write clock.force-rate / clock.force-quantum
+#   - set_driver_clock(): force rate / quantum of one driver (sink) group
+#
+# "subprocess" drives pw-dump / pw-cli / pw-metadata, "native" talks to
+# libpipewire-0.3 directly (see pwnative.py), "memory" is fed by hand and is
+# handed to RateEngine as an instance (bench/check_engine.py).
+
+import abc
+import os
+
+from pwgraph import NodeTable, GraphWatcher
+from pwcli import PwCliSession, FormatCache, format_from_params
+from pwmeta import MetadataWriter
+from metrics import EXCEPTIONS
+
+
+class Backend(abc.ABC):
+    name = "base"
+
+    def __init__(self):
+        self.graph = NodeTable()
+        self.format_cache = FormatCache()
+        self.on_change = None
+        self.driver_clocks = {} # driver id -> (rate, quantum) we forced on it
+
+    def start(self, on_change):
+        self.on_change = on_change
+
+    def stop(self):
+        pass
+
+    def nodes(self, state=None, media_class=None):
+        return self.graph.select(state=state, media_class=media_class)
+
+    def read_formats(self, nodes):
+        # Returns {node_id: (rate, fmt)}. The node's own Format param wins,
+        # then the cache, and only what is left gets probed in one batch.
+        info = {}
+        to_probe = []
+        for node in nodes:
+            found = format_from_params(node.get('info', {})) or self.format_cache.get(node)
+            if found: info[node['id']] = found
+            else: to_probe.append(node)
+
+        if to_probe:
+            try:
+                results = self.probe([n['id'] for n in to_probe])
+            except Exception as e:
+                EXCEPTIONS.inc(where="probe")
+                print(f"[{self.name}] {e}")
+                results = {}
+            for node in to_probe:
+                rate, fmt = results.get(node['id'], (None, "Unknown"))
+                if rate: self.format_cache.put(node, rate, fmt)
+                info[node['id']] = (rate, fmt)
+        return info
+
+    def probe(self, node_ids):
+        return {}
+
+    def bytes_parsed(self):
+        # Graph data read so far, for the metrics
+        return 0
+
+    @abc.abstractmethod
+    def set_clock(self, settings, force=False):
+        # settings: {"clock.force-rate": 44100, ...}, returns what was written.
+        # force writes even what the metadata already holds (switch retries)
+        pass
+
+    def get_setting(self, key):
+        return "0"
+
+    def set_driver_clock(self, driver_id, rate, quantum=0, force=False):
+        # Forces the rate of one driver's group through the node.force-rate /
+        # node.force-quantum props, leaving other sinks alone. 0 releases it.
+        # Returns False when the driver already has exactly that.
+        target = (int(rate), int(quantum))
+        if self.driver_clocks.get(driver_id, (0, 0)) == target and not force:
+            return False
+        self.write_driver_clock(driver_id, *target)
+        if target == (0, 0):
+            self.driver_clocks.pop(driver_id, None)
+        else:
+            self.driver_clocks[driver_id] = target
+        return True
+
+    @abc.abstractmethod
+    def write_driver_clock(self, driver_id, rate, quantum):
+        pass
+
+    def changed(self, changes):
+        for kind, node_id in changes:
+            if kind == "removed":
+                self.format_cache.evict(node_id)
+                self.driver_clocks.pop(node_id, None)
+        if self.on_change:
+            self.on_change(changes)
+
+
+class SubprocessBackend(Backend):
+    name = "subprocess"
+
+    def __init__(self):
+        super().__init__()
+        self.watcher = GraphWatcher(self.graph, on_change=self.changed)
+        self.pw_cli = PwCliSession(timeout=1.0)
+        self.metadata = MetadataWriter("settings")
+
+    def start(self, on_change):
+        super().start(on_change)
+        self.metadata.start()
+        self.watcher.start()
+
+    def stop(self):
+        self.watcher.stop()
+        self.metadata.stop()
+        self.pw_cli.close()
+
+    def probe(self, node_ids):
+        return self.pw_cli.enum_formats(node_ids)
+
+    def bytes_parsed(self):
+        return self.watcher.stats.get('bytes', 0)
+
+    def set_clock(self, settings, force=False):
+        return self.metadata.apply(settings, force=force)
+
+    def get_setting(self, key):
+        return self.metadata.get(key)
+
+    def write_driver_clock(self, driver_id, rate, quantum):
+        self.pw_cli.send(f'set-param {driver_id} Props {{ params = [ '
+                         f'"node.force-rate" {rate} "node.force-quantum" {quantum} ] }}')
+
+
+class MemoryBackend(Backend):
+    # In-process stand-in: push() pw-dump style objects, read back self.clock
+    name = "memory"
+
+    def __init__(self, formats=None):
+        super().__init__()
+        self.formats = dict(formats or {}) # node_id -> (rate, fmt) for probe()
+        self.clock = {}
+        self.writes = []
+
+    def push(self, objects):
+        changes = []
+        for obj in objects:
+            kind = self.graph.apply(obj)
+            if kind:
+                changes.append((kind, obj.get('id')))
+        if changes:
+            self.changed(changes)
+
+    def probe(self, node_ids):
+        return {i: self.formats.get(i, (None, "Unknown")) for i in node_ids}
+
+    def set_clock(self, settings, force=False):
+        changes = [(key, str(value)) for key, value in settings.items()
+                   if force or self.clock.get(key, "0") != str(value)]
+        self.clock.update(changes)
+        self.writes.extend(changes)
+        return changes
+
+    def get_setting(self, key):
+        return self.clock.get(key, "0")
+
+    def write_driver_clock(self, driver_id, rate, quantum):
+        self.writes.append((driver_id, rate, quantum))
+
+
+BACKENDS = ("subprocess", "native")
+
+
+def select_backend(name=None):
+    # --backend wins, then $PW_RATE_SWITCHER_BACKEND, then the subprocess one.
+    # "auto" uses libpipewire when it can be loaded.
+    name = name or os.environ.get("PW_RATE_SWITCHER_BACKEND") or "subprocess"
+    if name in ("native", "auto"):
+        try:
+            from pwnative import NativeBackend
+            return NativeBackend()
+        except Exception as e:
+            if name == "native":
+                raise
+            print(f"[Backend] libpipewire not usable ({e}), using subprocess")
+    elif name != "subprocess":
+        raise ValueError(f"Unknown backend '{name}', expected one of: {', '.join(BACKENDS)}, auto")
+    return SubprocessBackend()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# ==============================================================================
+# === ENGINE CHECKS ===
+# ==============================================================================
+# Drives a RateEngine in-process through the MemoryBackend (no PipeWire, no
+# pw-* tools) and checks the clock writes it makes:
+#   - one stream forces the global clock and no single sink
+#   - two streams on two sinks at different rates force each sink on its own,
+#     and once one of them stops the other goes back to the global clock
+#
+#   python3 bench/check_engine.py
+#
+# Exits 1 when a check fails. Takes a few seconds: the schedulers' coalesce
+# window and idle hold run in real time.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+from scenario import node, link, with_state
+
+# Device caches and rules must not come from (or go to) this machine's own
+_WORK = tempfile.mkdtemp(prefix="pw-check-")
+for var in ("XDG_RUNTIME_DIR", "XDG_CACHE_HOME", "XDG_CONFIG_HOME", "XDG_STATE_HOME"):
+    os.environ[var] = _WORK
+
+from backend import MemoryBackend
+from engine import RateEngine
+
+
+class CheckFailed(AssertionError):
+    pass
+
+
+def sink(node_id, name):
+    return node(node_id, "Audio/Sink", name, **{"device.api": "alsa"})
+
+
+def stream(node_id, name, rate, fmt):
+    return node(node_id, "Stream/Output/Audio", name,
+                **{"application.name": name, "audio.rate": rate, "audio.format": fmt})
+
+
+def wait_for(what, check, timeout=8.0):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            raise CheckFailed(f"timed out waiting for {what}")
+        time.sleep(0.02)
+
+
+class EngineRun:
+    def __init__(self, objects):
+        self.backend = MemoryBackend()
+        self.engine = RateEngine(backend=self.backend)
+        self.engine.xruns.available = False # No pw-top in here
+        self.objects = {obj["id"]: obj for obj in objects}
+
+    def __enter__(self):
+        self.engine.start()
+        self.backend.push(list(self.objects.values()))
+        return self
+
+    def __exit__(self, *exc):
+        self.engine.stop()
+
+    def set_state(self, node_id, state):
+        self.backend.push([with_state(self.objects[node_id], state)])
+
+    def driver_writes(self, driver):
+        return [entry[1:] for entry in self.backend.writes if entry[0] == driver]
+
+
+def check_single_stream():
+    with EngineRun([sink(40, "dac"), stream(50, "player", 44100, "S16LE"), link(60, 50, 40)]) as run:
+        run.set_state(50, "running")
+        wait_for("clock.force-rate 44100", lambda: run.backend.clock.get("clock.force-rate") == "44100")
+        if run.driver_writes(40):
+            raise CheckFailed(f"sink forced on its own: {run.driver_writes(40)}")
+        state = run.engine.snapshot()
+        if (state["rate"], state["app"], state["format"]) != ("44100", "player", "S16LE"):
+            raise CheckFailed(f"published {state['rate']} {state['app']} {state['format']}")
+
+
+def check_two_sinks():
+    objects = [sink(40, "dac"), sink(41, "hdmi"),
+               stream(50, "player", 44100, "S16LE"), stream(51, "video", 96000, "S24LE"),
+               link(60, 50, 40), link(61, 51, 41)]
+    with EngineRun(objects) as run:
+        run.set_state(50, "running")
+        run.set_state(51, "running")
+        wait_for("both sinks forced", lambda: run.backend.driver_clocks == {40: (44100, 0), 41: (96000, 0)})
+        if run.backend.clock.get("clock.force-rate", "0") != "0":
+            raise CheckFailed(f"global clock still forced to {run.backend.clock['clock.force-rate']}")
+        if run.engine.snapshot()["sinks"] != {"dac": 44100, "hdmi": 96000}:
+            raise CheckFailed(f"published sinks {run.engine.snapshot()['sinks']}")
+
+        # Past the idle hold only the dac is left: one target, the global clock
+        run.set_state(51, "idle")
+        wait_for("global clock.force-rate 44100", lambda: run.backend.clock.get("clock.force-rate") == "44100")
+        if run.backend.driver_clocks:
+            raise CheckFailed(f"sinks still forced: {run.backend.driver_clocks}")
+        for driver in (40, 41):
+            if run.driver_writes(driver)[-1] != (0, 0):
+                raise CheckFailed(f"sink {driver} not released: {run.driver_writes(driver)}")
+
+
+CHECKS = [check_single_stream, check_two_sinks]
+
+
+def main():
+    failed = 0
+    try:
+        for check in CHECKS:
+            name = check.__name__[len("check_"):]
+            try:
+                check()
+                print(f"[ok]   {name}")
+            except CheckFailed as e:
+                failed += 1
+                print(f"[FAIL] {name}: {e}")
+    finally:
+        shutil.rmtree(_WORK, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# ==============================================================================
+# === FAKE PIPEWIRE TOOLS (shared part) ===
+# ==============================================================================
+# pw-dump, pw-cli, pw-metadata and pw-top in this directory replay a scenario file
+# instead of talking to PipeWire. bench/run.py puts them first on PATH.
+#
+# Everything lives in $FAKEPW_DIR:
+#   scenario.json  graph at t=0, timed updates, pw-cli formats
+#   start          wall-clock time the scenario started (t=0)
+#   settings.json  current "settings" metadata
+#   spawns.log     one line per tool started: "<time> <argv>"
+#   writes.log     one line per metadata write: "<time> <key> <value>"
+
+import fcntl
+import json
+import os
+import sys
+import time
+
+DIR = os.environ.get("FAKEPW_DIR", ".")
+
+
+def path(name):
+    return os.path.join(DIR, name)
+
+
+def append(name, line):
+    with open(path(name), "a") as f:
+        f.write(line + "\n")
+
+
+def log_spawn():
+    append("spawns.log", f"{time.time():.6f} {os.path.basename(sys.argv[0])} {' '.join(sys.argv[1:])}")
+
+
+def load_scenario():
+    with open(path("scenario.json")) as f:
+        return json.load(f)
+
+
+def elapsed():
+    with open(path("start")) as f:
+        return time.time() - float(f.read())
+
+
+def graph_at(scenario, t):
+    # Graph as it stands t seconds into the scenario, {id: object}
+    graph = {obj["id"]: obj for obj in scenario["graph"]}
+    for event in scenario.get("events", ()):
+        if event["t"] > t:
+            break
+        apply(graph, event["objects"])
+    return graph
+
+
+def apply(graph, objects):
+    for obj in objects:
+        if obj.get("info", {}) is None:
+            graph.pop(obj["id"], None)
+        else:
+            graph[obj["id"]] = obj
+
+
+def print_batch(objects):
+    # Same layout as the real pw-dump: one pretty-printed array per update
+    sys.stdout.write(json.dumps(objects, indent=2) + "\n")
+    sys.stdout.flush()
+
+
+def read_settings():
+    try:
+        with open(path("settings.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_setting(key, value):
+    with open(path("settings.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        settings = read_settings()
+        settings[key] = value
+        tmp = path("settings.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(settings, f)
+        os.replace(tmp, path("settings.json"))
+    append("writes.log", f"{time.time():.6f} {key} {value}")
+
+
+def sleep_forever():
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# ==============================================================================
+# === DETECTION LOOP BENCHMARK ===
+# ==============================================================================
+# Runs the switcher against the fake pw-dump / pw-cli / pw-metadata in
+# bench/fakepw and reports:
+#   - time from a stream starting to clock.force-rate being written, and the
+#     format the switcher published for it (from its history)
+#   - CPU seconds per hour of the switcher, per scenario phase (idle, playback)
+#   - pw-* processes spawned per minute, per phase
+#   - peak RSS of the switcher
+#
+#   python3 bench/run.py --nodes 2000
+#   python3 bench/run.py --scenario recorded.json --json > after.json
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(1, REPO_DIR)
+import scenario as scenarios
+from control import ControlClient, ControlError
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK # utime + stime
+
+
+def peak_rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def read_log(path):
+    entries = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if parts:
+                    entries.append((float(parts[0]), parts[1:]))
+    return entries
+
+
+class SwitcherExited(RuntimeError):
+    pass
+
+
+def check_alive(proc, log_path):
+    # A switcher that died would otherwise show up as "never switched"
+    if proc.poll() is None:
+        return
+    with open(log_path, errors="replace") as f:
+        tail = f.read()[-2000:]
+    raise SwitcherExited(f"switcher exited with {proc.returncode} during the scenario:\n{tail}")
+
+
+def run(scenario, cmd, settle=1.0):
+    work = tempfile.mkdtemp(prefix="pw-bench-")
+    try:
+        with open(os.path.join(work, "scenario.json"), "w") as f:
+            json.dump(scenario, f)
+        env = dict(os.environ)
+        env["FAKEPW_DIR"] = work
+        env["PATH"] = os.path.join(BENCH_DIR, "fakepw") + os.pathsep + env["PATH"]
+        env["PW_RATE_SWITCHER_BACKEND"] = "subprocess"
+        # Own control socket, caches and rules: a switcher already running on
+        # this machine must neither clash with nor leak into the run
+        for var in ("XDG_RUNTIME_DIR", "XDG_CACHE_HOME", "XDG_CONFIG_HOME", "XDG_STATE_HOME"):
+            env[var] = work
+
+        start = time.time()
+        with open(os.path.join(work, "start"), "w") as f:
+            f.write(repr(start))
+        log_path = os.path.join(work, "switcher.log")
+        with open(log_path, "w") as log:
+            proc = subprocess.Popen(cmd, env=env, cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT)
+
+        phases = []
+        try:
+            for phase in scenario["phases"]:
+                time.sleep(max(0, start + phase["start"] - time.time()))
+                check_alive(proc, log_path)
+                cpu_start = cpu_seconds(proc.pid)
+                time.sleep(max(0, start + phase["end"] - time.time()))
+                check_alive(proc, log_path)
+                cpu_end = cpu_seconds(proc.pid)
+                phases.append((phase, cpu_end - cpu_start))
+            time.sleep(settle)
+            check_alive(proc, log_path)
+            rss = peak_rss_kb(proc.pid)
+            published = switcher_history(work, time.time() - start)
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+        spawns = read_log(os.path.join(work, "spawns.log"))
+        writes = read_log(os.path.join(work, "writes.log"))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {"nodes": sum(1 for o in scenario["graph"] if o.get("type") == scenarios.NODE_TYPE),
+              "peak_rss_kb": rss, "phases": {}, "switches": []}
+    for phase, cpu in phases:
+        length = phase["end"] - phase["start"]
+        lo, hi = start + phase["start"], start + phase["end"]
+        spawned = sum(1 for t, _ in spawns if lo <= t < hi)
+        report["phases"][phase["name"]] = {
+            "cpu_s_per_hour": round(cpu / length * 3600, 2),
+            "spawns_per_min": round(spawned / length * 60, 2),
+        }
+
+    events = scenario.get("events", ())
+    for i, event in enumerate(events):
+        if "expect_rate" not in event:
+            continue
+        at = start + event["t"]
+        until = start + events[i + 1]["t"] if i + 1 < len(events) else float("inf")
+        hit = next((t for t, (key, value) in writes
+                    if t >= at and key == "clock.force-rate" and value == str(event["expect_rate"])), None)
+        # The format the switcher last showed for the stream before the next event
+        formats = [entry[6] for entry in published
+                   if at <= entry[0] < until and entry[1] == "change" and entry[2] == event["expect_rate"]
+                   and entry[6] not in ("", "None", "Unknown")]
+        report["switches"].append({
+            "t": event["t"], "rate": event["expect_rate"],
+            "time_to_switch_ms": round((hit - at) * 1000, 1) if hit else None,
+            "format": formats[-1] if formats else None,
+            "expect_format": event.get("expect_format"),
+        })
+    return report
+
+
+def switcher_history(work, seconds):
+    # [time, kind, rate, quantum, latency ms, app, format] from the control
+    # socket; empty for a switcher command that doesn't serve one
+    try:
+        return ControlClient(os.path.join(work, "pw-rate-switcher.sock")).history_since(seconds + 1)
+    except (OSError, ControlError):
+        return []
+
+
+def print_report(report):
+    print(f"Nodes in graph:   {report['nodes']}")
+    print(f"Peak RSS:         {report['peak_rss_kb'] / 1024:.1f} MB")
+    for name, phase in report["phases"].items():
+        print(f"[{name}] CPU {phase['cpu_s_per_hour']} s/hour, {phase['spawns_per_min']} spawns/min")
+    for switch in report["switches"]:
+        ms = switch["time_to_switch_ms"]
+        fmt = switch["format"] or "no format"
+        if switch["expect_format"] and switch["format"] != switch["expect_format"]:
+            fmt += f", expected {switch['expect_format']}"
+        print(f"  t={switch['t']:6.1f}s -> {switch['rate']} Hz: " +
+              (f"{ms} ms" if ms is not None else "never switched") + f" ({fmt})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detection loop against fake PipeWire tools")
+    parser.add_argument("--scenario", help="Scenario file (default: generate one)")
+    parser.add_argument("--nodes", type=int, default=200, help="Nodes in the generated graph")
+    parser.add_argument("--idle", type=float, default=20.0, help="Seconds of idle before playback")
+    parser.add_argument("--playback", type=float, default=40.0, help="Seconds of playback")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("cmd", nargs=argparse.REMAINDER,
+                        help="Switcher command (default: pw-rate-switcher.py --daemon)")
+    args = parser.parse_args()
+
+    if args.scenario:
+        with open(args.scenario) as f:
+            scenario = json.load(f)
+    else:
+        scenario = scenarios.generate(args.nodes, args.idle, args.playback)
+    cmd = [a for a in args.cmd if a != "--"] or [sys.executable, os.path.join(REPO_DIR, "pw-rate-switcher.py"),
+                                                 "--daemon"]
+
+    try:
+        report = run(scenario, cmd)
+    except SwitcherExited as e:
+        sys.exit(f"Error: {e}")
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
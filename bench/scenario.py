@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# ==============================================================================
+# === BENCHMARK SCENARIOS ===
+# ==============================================================================
+# Builds the scenario files the fake pw-* tools replay.
+#
+#   scenario.py generate --nodes 200 -o s.json    synthetic graph + timeline
+#   scenario.py record --seconds 60 -o s.json     capture the real pw-dump -m
+#
+# A scenario is {"graph": [...], "events": [{"t", "objects", "expect_rate"?}],
+# "formats": {id: {"rate", "format"}}, "phases": [{"name", "start", "end"}]}.
+# expect_rate marks an event after which the clock should move to that rate,
+# expect_format the format the switcher should show for that stream.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pwdump import NODE_TYPE, iter_objects
+
+
+def node(node_id, media_class, name, state="suspended", **props):
+    props.update({"media.class": media_class, "node.name": name, "object.serial": node_id + 1000})
+    return {
+        "id": node_id, "type": NODE_TYPE, "version": 3,
+        "permissions": ["r", "w", "x", "m"],
+        "info": {
+            "max-input-ports": 0, "max-output-ports": 0,
+            "change-mask": ["input-ports", "output-ports", "state", "props", "params"],
+            "n-input-ports": 0, "n-output-ports": 2,
+            "state": state, "error": None, "props": props,
+            "params": {"EnumFormat": [], "Props": [{"volume": 1.0, "mute": False}]},
+        },
+    }
+
+
+def port(port_id, node_id, direction):
+    return {"id": port_id, "type": "PipeWire:Interface:Port", "version": 3, "permissions": ["r"],
+            "info": {"direction": direction, "change-mask": ["props", "params"],
+                     "props": {"node.id": node_id, "port.direction": direction,
+                               "port.name": f"{direction}_FL", "audio.channel": "FL"},
+                     "params": {}}}
+
+
+def link(link_id, out_node, in_node):
+    return {"id": link_id, "type": "PipeWire:Interface:Link", "version": 3, "permissions": ["r"],
+            "info": {"output-node-id": out_node, "output-port-id": 0,
+                     "input-node-id": in_node, "input-port-id": 0,
+                     "state": "active", "error": None, "props": {}}}
+
+
+def with_state(obj, state):
+    obj = json.loads(json.dumps(obj))
+    obj["info"]["state"] = state
+    return obj
+
+
+def generate(nodes=200, idle=20.0, playback=40.0):
+    # Two sinks, a few player streams that take turns, padding up to `nodes`
+    graph = [
+        node(40, "Audio/Sink", "alsa_output.usb-DAC", state="suspended"),
+        node(41, "Audio/Sink", "alsa_output.pci-hdmi", state="suspended"),
+    ]
+    players = {
+        # Publishes audio.rate/format, the easy case
+        50: node(50, "Stream/Output/Audio", "strawberry", **{"application.name": "Strawberry"}),
+        # Spotify-style: fractional node.rate, no rate/format, needs pw-cli
+        51: node(51, "Stream/Output/Audio", "spotify", **{"application.name": "spotify"}),
+        # Browser tab whose format pw-cli can't read either
+        52: node(52, "Stream/Output/Audio", "Firefox", **{"application.name": "Firefox"}),
+    }
+    players[50]["info"]["props"].update({"audio.rate": 96000, "audio.format": "S24LE",
+                                         "node.latency": "2048/96000"})
+    players[51]["info"]["props"].update({"node.rate": "1/44100", "node.latency": "1024/44100"})
+    players[52]["info"]["props"].update({"node.rate": "1/48000", "node.latency": "960/48000"})
+    graph += players.values()
+
+    classes = ("Video/Source", "Midi/Bridge", "Audio/Source", "Stream/Input/Audio", "Stream/Output/Audio")
+    next_id = 100
+    while sum(1 for o in graph if o["type"] == NODE_TYPE) < nodes:
+        media_class = classes[next_id % len(classes)]
+        graph.append(node(next_id, media_class, f"filler.{next_id}"))
+        next_id += 1
+    for obj in list(graph):
+        if obj["type"] == NODE_TYPE:
+            graph.append(port(next_id, obj["id"], "output"))
+            next_id += 1
+    for obj in players.values():
+        graph.append(link(next_id, obj["id"], 40))
+        next_id += 1
+
+    step = playback / 6
+    t = idle
+    events = [
+        {"t": t, "expect_rate": 96000, "expect_format": "S24LE",
+         "objects": [with_state(players[50], "running")]},
+        {"t": t + step, "objects": [with_state(players[50], "idle")]},
+        {"t": t + step * 1.2, "expect_rate": 44100, "expect_format": "F32LE",
+         "objects": [with_state(players[51], "running")]},
+        {"t": t + step * 3, "objects": [with_state(players[51], "idle")]},
+        {"t": t + step * 3.2, "expect_rate": 48000, "objects": [with_state(players[52], "running")]},
+        {"t": t + step * 5, "objects": [with_state(players[52], "idle")]},
+        {"t": t + step * 5.2, "expect_rate": 96000, "expect_format": "S24LE",
+         "objects": [with_state(players[50], "running")]},
+    ]
+    return {
+        "graph": graph,
+        "events": events,
+        "formats": {"51": {"rate": 44100, "format": "F32LE"}},
+        "phases": [{"name": "idle", "start": 1.0, "end": idle},
+                   {"name": "playback", "start": idle, "end": idle + playback}],
+    }
+
+
+def record(seconds):
+    # Captures the live graph and every update for `seconds`
+    proc = subprocess.Popen(["pw-dump", "--monitor"], stdout=subprocess.PIPE)
+    start = time.time()
+    graph, events, batch = None, [], []
+    try:
+        for obj in iter_objects(proc.stdout, removals=True, batches=True):
+            if obj is not None:
+                batch.append(obj)
+                continue
+            if graph is None:
+                graph = batch
+            else:
+                events.append({"t": round(time.time() - start, 3), "objects": batch})
+            batch = []
+            if time.time() - start >= seconds:
+                break
+    finally:
+        proc.terminate()
+    return {"graph": graph or [], "events": events, "formats": {},
+            "phases": [{"name": "replay", "start": 0.0, "end": float(seconds)}]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build scenarios for bench/run.py")
+    sub = parser.add_subparsers(dest="command", required=True)
+    gen = sub.add_parser("generate")
+    gen.add_argument("--nodes", type=int, default=200)
+    gen.add_argument("--idle", type=float, default=20.0)
+    gen.add_argument("--playback", type=float, default=40.0)
+    gen.add_argument("-o", "--output", required=True)
+    rec = sub.add_parser("record")
+    rec.add_argument("--seconds", type=float, default=60.0)
+    rec.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        scenario = generate(args.nodes, args.idle, args.playback)
+    else:
+        scenario = record(args.seconds)
+    with open(args.output, "w") as f:
+        json.dump(scenario, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# ==============================================================================
+# === DAC CAPABILITY CACHE ===
+# ==============================================================================
+# What rates and sample formats each sink can take, read from its EnumFormat
+# param while it is not running (a running ALSA sink only lists what it is
+# currently configured for) and kept on disk, so a restart knows every DAC
+# without probing anything:
+#
+#   ~/.cache/pw-rate-switcher/devices.json
+#   {"alsa_output.usb-...|<serial>": {"fingerprint": "...", "rates": [...], "formats": [...]}}
+#
+# Entries are keyed by node name plus whatever identifies the physical device.
+# The fingerprint covers the properties that change what the device offers
+# (profile, card, codec), a device that comes back with different ones is
+# read again.
+
+import hashlib
+import json
+import os
+import threading
+
+# Rates offered by the manual buttons and tried when a DAC only gives a range
+STANDARD_RATES = (44100, 48000, 88200, 96000, 176400, 192000, 352800, 384000)
+
+_IDENTITY_PROPS = ("device.serial", "api.alsa.card.longname", "api.bluez5.address", "device.bus-path")
+_FINGERPRINT_PROPS = ("api.alsa.path", "api.alsa.pcm.card", "api.alsa.card.name", "device.profile.name",
+                      "device.product.id", "device.vendor.id", "api.bluez5.codec", "audio.position")
+
+
+def cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "pw-rate-switcher", "devices.json")
+
+
+def _props(node):
+    return ((node or {}).get('info') or {}).get('props') or {}
+
+
+def device_key(node):
+    props = _props(node)
+    identity = next((str(props[p]) for p in _IDENTITY_PROPS if props.get(p)), "")
+    return f"{props.get('node.name', node.get('id'))}|{identity}"
+
+
+def fingerprint(node):
+    props = _props(node)
+    text = json.dumps([props.get(p) for p in _FINGERPRINT_PROPS])
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def _values(choice):
+    # pw-dump writes choices as {"default": x, "alternatives": [...]} or
+    # {"default": x, "min": a, "max": b}, plain values as themselves
+    if isinstance(choice, dict):
+        if "alternatives" in choice:
+            return list(choice["alternatives"]) or [choice.get("default")]
+        if "min" in choice and "max" in choice:
+            return [("range", choice["min"], choice["max"])]
+        return [choice.get("default")]
+    if isinstance(choice, list):
+        return choice
+    return [choice]
+
+
+def caps_from_params(info):
+    # {"rates": [...], "formats": [...]} from info.params.EnumFormat, None
+    # when the node doesn't list any audio formats
+    entries = ((info or {}).get('params') or {}).get('EnumFormat') or []
+    rates, formats = set(), set()
+    for entry in entries:
+        if not isinstance(entry, dict) or entry.get("mediaSubtype", "raw") != "raw":
+            continue
+        for value in _values(entry.get("rate")):
+            if isinstance(value, tuple):
+                rates.update(r for r in STANDARD_RATES if value[1] <= r <= value[2])
+            elif isinstance(value, int) and value > 0:
+                rates.add(value)
+        for value in _values(entry.get("format")):
+            if isinstance(value, str):
+                formats.add(value)
+    if not rates:
+        return None
+    return {"rates": sorted(rates), "formats": sorted(formats)}
+
+
+class CapabilityCache:
+    def __init__(self, path=None):
+        self.path = path or cache_path()
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.fingerprints = {} # node id -> fingerprint already checked, skips rehashing
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, node):
+        # The cached entry of a sink, None if unknown or out of date
+        if node is None:
+            return None
+        entry = self.entries.get(device_key(node))
+        if entry and entry.get("fingerprint") == fingerprint(node):
+            return entry
+        return None
+
+    def learn(self, node):
+        # Reads the sink's EnumFormat into the cache unless an up-to-date
+        # entry exists. Returns True when the cache changed.
+        info = node.get('info') or {}
+        if info.get('state') == "running":
+            return False
+        mark = fingerprint(node)
+        if self.fingerprints.get(node['id']) == mark:
+            return False
+        key = device_key(node)
+        entry = self.entries.get(key)
+        if entry and entry.get("fingerprint") == mark:
+            self.fingerprints[node['id']] = mark
+            return False
+        caps = caps_from_params(info)
+        if caps is None:
+            return False # EnumFormat not there (yet), try on the next update
+        caps["fingerprint"] = mark
+        with self.lock:
+            self.entries[key] = caps
+        self.fingerprints[node['id']] = mark
+        print(f"[Caps] {_props(node).get('node.description') or key}: "
+              f"{', '.join(str(r) for r in caps['rates'])} Hz")
+        self.save()
+        return True
+
+    def forget(self, node_id):
+        self.fingerprints.pop(node_id, None)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries, indent=1, sort_keys=True)
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[Caps] {e}")
+
+    def best_rate(self, node, rate):
+        # The rate to force on `node` for a stream at `rate`: the rate itself
+        # when the DAC takes it, else the nearest whole multiple it supports
+        # (a clean 2x/4x upsample), else the next higher one, else its highest
+        entry = self.get(node)
+        rate = int(rate)
+        if not entry or rate in entry["rates"]:
+            return rate
+        rates = entry["rates"]
+        multiples = [r for r in rates if r > rate and r % rate == 0]
+        if multiples:
+            return min(multiples)
+        higher = [r for r in rates if r > rate]
+        return min(higher) if higher else max(rates)
+
+    def rates(self, nodes):
+        # Union of the rates the given sinks support, None if none is known
+        known = [self.get(node) for node in nodes]
+        known = [entry for entry in known if entry]
+        if not known:
+            return None
+        return sorted(set(r for entry in known for r in entry["rates"]))
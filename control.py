@@ -0,0 +1,252 @@
+# ==============================================================================
+# === CONTROL SOCKET ===
+# ==============================================================================
+# Lets other processes drive a running RateEngine (the --daemon, or the GTK
+# app): a Unix socket in $XDG_RUNTIME_DIR, one JSON object per line.
+#
+#   {"cmd": "status"}                          -> {"ok": true, "state": {...}}
+#   {"cmd": "set_mode", "mode": "strict"}      strict / auto / manual
+#   {"cmd": "set_strict", "on": true}
+#   {"cmd": "set_auto", "on": false}
+#   {"cmd": "set_rate", "rate": 96000}         manual override
+#   {"cmd": "metrics"}                         -> {"ok": true, "text": "<Prometheus text>"}
+#   {"cmd": "profile", "seconds": 30, "memory": false}
+#                                              -> {"ok": true, "report": "<path>"}, written
+#                                                 once the monitor loop was profiled that long
+#   {"cmd": "history", "seconds": 3600}        -> {"ok": true, "entries": [[time, kind, rate, quantum,
+#                                                 latency ms, app, format], ...]}, oldest first
+#   {"cmd": "startup"}                         -> {"ok": true, "seconds": {"first_lock": 0.4, ...},
+#                                                 "processes": [...], "total_rss_kb": ...}
+#   {"cmd": "show"}                            bring up the window (the tray uses this)
+#   {"cmd": "subscribe"}                       -> {"ok": true, "state": {...}}
+#                                                 then {"event": ..., "state": ...}
+#                                                 per change until the client leaves
+#
+# Errors come back as {"ok": false, "error": "..."}.
+#
+#   echo '{"cmd":"status"}' | socat - UNIX-CONNECT:$XDG_RUNTIME_DIR/pw-rate-switcher.sock
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+
+from metrics import METRICS, STARTUP
+
+
+def socket_path():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, "pw-rate-switcher.sock")
+    return f"/tmp/pw-rate-switcher-{os.getuid()}.sock"
+
+
+class ControlError(Exception):
+    pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                name = request.get("cmd", "")
+                command = getattr(self.server, "cmd_" + name, None)
+                if command is None:
+                    raise ControlError(f"Unknown command '{name}'")
+                if name == "subscribe":
+                    self.stream_events()
+                    return
+                reply = {"ok": True}
+                reply.update(command(request) or {})
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            if not self.send(reply):
+                return
+
+    def send(self, obj):
+        try:
+            self.wfile.write((json.dumps(obj) + "\n").encode())
+            self.wfile.flush()
+            return True
+        except OSError:
+            return False
+
+    def stream_events(self):
+        # Engine thread -> queue -> this connection. A client that went away
+        # is noticed on the next write.
+        events = queue.Queue()
+        listener = lambda event, state: events.put({"event": event, "state": state})
+        engine = self.server.engine
+        engine.add_listener(listener)
+        try:
+            if not self.send({"ok": True, "state": engine.snapshot()}):
+                return
+            while not self.server.closing:
+                try:
+                    message = events.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                if not self.send(message):
+                    return
+        finally:
+            engine.remove_listener(listener)
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, engine, path=None):
+        self.engine = engine
+        self.path = path or socket_path()
+        self.closing = False
+        self.on_show = None # Set by the GTK app, a --daemon has no window
+        if os.path.exists(self.path):
+            if ping(self.path):
+                raise ControlError(f"Another switcher is already listening on {self.path}")
+            os.unlink(self.path) # Left over from a crash
+        super().__init__(self.path, _Handler)
+        os.chmod(self.path, 0o600)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.closing = True
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    # --- Commands ---
+
+    def cmd_status(self, request):
+        return {"state": self.engine.snapshot()}
+
+    def cmd_subscribe(self, request):
+        pass # Handled by the connection itself
+
+    def cmd_metrics(self, request):
+        return {"text": METRICS.render()}
+
+    def cmd_history(self, request):
+        return {"entries": self.engine.history_since(float(request.get("seconds", 3600)))}
+
+    def cmd_startup(self, request):
+        return STARTUP.report()
+
+    def cmd_show(self, request):
+        if self.on_show is None:
+            raise ControlError("No window to show (running headless)")
+        self.on_show()
+        return {}
+
+    def cmd_profile(self, request):
+        path = self.engine.profiler.request(seconds=request.get("seconds", 30),
+                                            memory=request.get("memory", False))
+        return {"report": path}
+
+    def cmd_set_mode(self, request):
+        self.engine.set_mode(request.get("mode"))
+        return {"state": self.engine.snapshot()}
+
+    def cmd_set_strict(self, request):
+        self.engine.set_strict(bool(request.get("on")))
+        return {"state": self.engine.snapshot()}
+
+    def cmd_set_auto(self, request):
+        self.engine.set_auto(bool(request.get("on")))
+        return {"state": self.engine.snapshot()}
+
+    def cmd_set_rate(self, request):
+        if not self.engine.set_manual_rate(int(request.get("rate", 0))):
+            raise ControlError("Strict Mode is on, manual rates are disabled")
+        return {"state": self.engine.snapshot()}
+
+
+class ControlClient:
+    # Same surface as RateEngine as far as the UI is concerned, so the GTK
+    # window can sit on top of a running daemon instead of its own engine.
+
+    def __init__(self, path=None, timeout=2.0):
+        self.path = path or socket_path()
+        self.timeout = timeout
+        self.subscriptions = []
+
+    def request(self, cmd, **args):
+        args["cmd"] = cmd
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall((json.dumps(args) + "\n").encode())
+            with sock.makefile("rb") as f:
+                reply = json.loads(f.readline() or b"{}")
+        if not reply.get("ok"):
+            raise ControlError(reply.get("error", "No reply from the switcher"))
+        return reply
+
+    def start(self):
+        self.request("status")
+
+    def stop(self):
+        for sock in self.subscriptions:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.subscriptions = []
+
+    def snapshot(self):
+        return self.request("status")["state"]
+
+    def metrics(self):
+        return self.request("metrics")["text"]
+
+    def history_since(self, seconds):
+        return [tuple(entry) for entry in self.request("history", seconds=seconds)["entries"]]
+
+    def set_mode(self, mode):
+        self.request("set_mode", mode=mode)
+
+    def set_strict(self, state):
+        self.request("set_strict", on=state)
+
+    def set_auto(self, state):
+        self.request("set_auto", on=state)
+
+    def set_manual_rate(self, rate):
+        try:
+            self.request("set_rate", rate=int(rate))
+            return True
+        except ControlError:
+            return False
+
+    def add_listener(self, listener):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(b'{"cmd": "subscribe"}\n')
+        self.subscriptions.append(sock)
+        threading.Thread(target=self._listen, args=(sock, listener), daemon=True).start()
+
+    def _listen(self, sock, listener):
+        with sock, sock.makefile("rb") as f:
+            for line in f:
+                message = json.loads(line)
+                if "event" in message:
+                    listener(message["event"], message["state"])
+                elif message.get("ok"):
+                    listener("mode", message["state"]) # Initial state
+        listener("closed", None)
+
+
+def ping(path=None):
+    # True when a switcher is answering on the socket
+    try:
+        ControlClient(path, timeout=0.5).request("status")
+        return True
+    except (OSError, ValueError, ControlError):
+        return False
@@ -0,0 +1,521 @@
+# ==============================================================================
+# === RATE ENGINE (no GTK) ===
+# ==============================================================================
+# Detection and switching without any UI: watches the graph through a backend,
+# decides per sink through the switch schedulers and writes the clock. The GTK
+# window, the tray and the --daemon control socket are all just listeners.
+#
+# Listeners are called as listener(event, state) from the engine thread, with
+# event one of "stream", "idle", "sinks", "mode", "xruns", "caps" and state a
+# copy of self.state.
+
+import threading
+import time
+
+from backend import Backend, select_backend
+from scheduler import SwitchScheduler
+from metrics import METRICS, EXCEPTIONS, STARTUP, Profiler
+from xrun import QuantumController, XrunMonitor
+from caps import CapabilityCache
+from verify import SwitchVerifier
+from pwcli import format_from_params
+from rules import RuleSet
+import history
+
+SCAN_SECONDS = METRICS.histogram("scan_seconds", "One pass of the monitor loop")
+TIME_TO_SWITCH = METRICS.histogram("time_to_switch_seconds", "From a stream starting to its rate being applied")
+CLOCK_WRITE_SECONDS = METRICS.histogram("clock_write_seconds", "Writing the global clock settings")
+READ_FORMATS = METRICS.counter("read_formats_total", "Lookups of rate/format for streams that hide them")
+
+
+class RateEngine:
+    def __init__(self, backend=None):
+        self.current_rate = "Unknown"
+        self.running = True
+        self.auto_mode = True
+        self.auto_requested = True # What the user asked for, restored when strict goes off
+        self.strict_mode = False
+        self.wakeup = threading.Event() # Set whenever the graph or a mode changes
+        # A backend name (see select_backend) or a ready Backend, e.g. a MemoryBackend
+        self.backend = backend if isinstance(backend, Backend) else select_backend(backend)
+        self.schedulers = {} # Driver (sink) node id -> SwitchScheduler, None = not linked yet
+        self.reset_scheduler = False # Set from other threads, handled by the monitor
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.started_at = {} # Stream id -> when it was first seen running, until it gets a clock
+        self.profiler = Profiler()
+        self.quantum = QuantumController() # Strict mode's quantum, stepped up on xruns
+        self.xruns = XrunMonitor(self.on_xrun_sample)
+        self.retune = False # Set when the controller moved a quantum
+        self.caps = CapabilityCache() # What each DAC supports, from disk
+        self.verifier = SwitchVerifier() # Did the drivers follow the last writes
+        self.reported = {} # Driver id -> (rate, quantum) from pw-top, for the verifier
+        self.rules = RuleSet() # Per-application ignore / prefer / pin / strict
+        self.history = history.History() # Fixed-size log of what the clock did
+        self.state = {
+            "rate": None, "app": None, "format": None, "latency": None,
+            "status": "Scanning...", "mode": "auto", "sinks": {}, "xruns": None,
+            "rates": None, # Rates the present sinks support, None = not known
+            "locks": {}, # Sink name -> {"status": pending/locked/rejected/unverified, "ms": time to lock}
+        }
+
+    def start(self):
+        METRICS.add_collector(self.collect_metrics)
+        self.backend.start(on_change=self.on_graph_change)
+        threading.Thread(target=self.monitor_pipewire, daemon=True).start()
+        STARTUP.mark("detection_started")
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        self.xruns.close()
+        self.backend.stop()
+        METRICS.remove_collector(self.collect_metrics)
+
+    def on_graph_change(self, changes):
+        for kind, node_id in changes:
+            if kind == "removed":
+                self.caps.forget(node_id)
+                self.quantum.forget(node_id)
+                self.reported.pop(node_id, None)
+            if kind != "added":
+                self.rules.forget(node_id)
+        self.wakeup.set()
+
+    def collect_metrics(self):
+        cache = self.backend.format_cache
+        yield "format_cache_hits_total", "counter", "Stream formats answered from the cache", cache.hits
+        yield "format_cache_misses_total", "counter", "Stream formats that had to be probed", cache.misses
+        yield "graph_bytes_total", "counter", "pw-dump output parsed", self.backend.bytes_parsed()
+        yield "locked_sinks", "gauge", "Sinks currently holding a forced rate", \
+            sum(1 for s in list(self.schedulers.values()) if s.current)
+
+    # --- State and listeners ---
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.state, sinks=dict(self.state["sinks"]))
+
+    def publish(self, event, **changes):
+        # Only real changes reach the listeners
+        with self.lock:
+            if all(self.state.get(k) == v for k, v in changes.items()):
+                return
+            self.state.update(changes)
+            state = dict(self.state, sinks=dict(self.state["sinks"]))
+            listeners = list(self.listeners)
+        if event in ("stream", "idle"):
+            self.record(history.CHANGE if event == "stream" else history.IDLE, state)
+        for listener in listeners:
+            try:
+                listener(event, state)
+            except Exception as e:
+                print(f"[Engine] Listener failed: {e}")
+
+    def record(self, kind, state):
+        try: latency = float(str(state.get("latency")).split()[0])
+        except ValueError: latency = 0.0
+        rate = state.get("rate")
+        self.history.record(kind, rate=int(rate) if str(rate).isdigit() else 0, latency=latency,
+                            app=state.get("app"), fmt=state.get("format"))
+
+    def history_since(self, seconds):
+        # History entries of the last `seconds`, oldest first
+        return self.history.since(time.time() - seconds)
+
+    # --- Modes ---
+
+    def mode(self):
+        if self.strict_mode: return "strict"
+        return "auto" if self.auto_mode else "manual"
+
+    def set_strict(self, state):
+        if state == self.strict_mode:
+            return
+        self.strict_mode = state
+        if state:
+            print("[Engine] Strict Mode ON: Taking full control.")
+            # Strict implies Auto
+            self.auto_mode = True
+        else:
+            print("[Engine] Strict Mode OFF: Restoring controls.")
+            self.auto_mode = self.auto_requested
+
+        # Reset monitoring to force immediate re-scan
+        self.current_rate = "Unknown"
+        self.reset_scheduler = True
+        self.wakeup.set()
+        self.publish("mode", mode=self.mode())
+
+    def set_auto(self, state):
+        self.auto_requested = state
+        # Only works if Strict Mode is OFF
+        if not self.strict_mode and state != self.auto_mode:
+            self.auto_mode = state
+            self.wakeup.set()
+            self.publish("mode", mode=self.mode())
+
+    def set_mode(self, mode):
+        if mode not in ("strict", "auto", "manual"):
+            raise ValueError(f"Unknown mode '{mode}'")
+        self.set_strict(mode == "strict")
+        if mode != "strict":
+            self.set_auto(mode == "auto")
+
+    def set_manual_rate(self, rate):
+        # Only works if Strict Mode is OFF, and turns Auto off
+        if self.strict_mode:
+            return False
+        self.set_auto(False)
+        self.apply_rate(str(int(rate)), 0)
+        # The global clock now, no sink is forced on its own
+        self.publish("sinks", sinks={})
+        self.publish("stream", rate=str(int(rate)), app="Manual", format=None, latency=None, status="Manual")
+        return True
+
+    # --- Detection and switching ---
+
+    def describe_stream(self, obj, dynamic_info, rule=None):
+        # Rate, quantum and display info of one running stream, None if its
+        # rate can't be worked out. `rule` is its matching rule, if any.
+        props = obj.get('info', {}).get('props', {})
+        node_id = obj.get('id')
+        name = props.get('node.name', 'Unknown')
+        app_name = props.get('application.name', name)
+
+        rate = None
+        fmt = props.get('audio.format')
+        
+        if props.get('audio.rate'): rate = props.get('audio.rate')
+
+        if not rate:
+            node_rate = props.get('node.rate')
+            if node_rate and isinstance(node_rate, str):
+                if '/' in node_rate:
+                    try:
+                        denom = node_rate.split('/')[1].strip()
+                        if denom.isdigit(): rate = denom
+                    except: pass
+                elif node_rate.strip().isdigit():
+                    rate = node_rate.strip()
+
+        if not rate or str(rate) == "0" or not fmt or fmt == "Unknown":
+            dyn_rate, dyn_fmt = dynamic_info.get(node_id, (None, "Unknown"))
+            if not rate or str(rate) == "0": rate = dyn_rate
+            if dyn_fmt != "Unknown": fmt = dyn_fmt
+            
+        lat_str = props.get('node.latency')
+        current_quantum = 0
+        latency_ms = "-- ms"
+        
+        if lat_str and '/' in str(lat_str):
+            try:
+                parts = str(lat_str).split('/')
+                samples = float(parts[0])
+                freq = float(parts[1])
+                ms = (samples / freq) * 1000
+                latency_ms = f"{ms:.1f} ms"
+                current_quantum = int(samples)
+            except: pass
+
+        action = rule.action if rule else None
+        if action == "pin":
+            rate = str(rule.rate)
+        if not (rate and str(rate).isdigit() and int(rate) > 0):
+            return None
+        try: serial = int(props.get('object.serial', node_id))
+        except (TypeError, ValueError): serial = node_id
+        driver = self.backend.graph.resolve_driver(node_id)
+        # A rate the DAC can't take would only get resampled by PipeWire
+        native_rate = rate
+        if driver is not None and action != "pin":
+            native_rate = self.caps.best_rate(self.backend.graph.get(driver), rate)
+        return {
+            'id': node_id,
+            'serial': serial,
+            'driver': driver,
+            'rate': str(native_rate),
+            'stream_rate': str(rate),
+            # Strict mode follows the stream's quantum, otherwise leave it to PipeWire
+            'quantum': current_quantum if self.strict_mode or action == "strict" else 0,
+            'priority': rule.priority if rule else 0,
+            'app': app_name,
+            'format': fmt,
+            'latency': latency_ms,
+        }
+
+    def monitor_pipewire(self):
+        while self.running:
+            # Sleep until the graph watcher reports a change (or a mode toggle).
+            # The timeout only serves the scheduler's timers.
+            timeout = 1.0
+            wake_times = [s.wake_at for s in list(self.schedulers.values())] + [self.verifier.wake_at]
+            for wake_at in wake_times:
+                if wake_at is not None:
+                    timeout = max(0.01, min(timeout, wake_at - time.monotonic()))
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            self.profiler.tick()
+
+            scan_start = time.perf_counter()
+            try:
+                if self.reset_scheduler:
+                    self.reset_scheduler = False
+                    self.schedulers.clear()
+                if self.retune:
+                    self.retune = False
+                    if any(s.current for s in self.schedulers.values()):
+                        self.apply_clocks()
+
+                # Sinks are read while they are idle, the cache skips known ones
+                sinks = self.backend.nodes(media_class="Audio/Sink")
+                for sink in sinks:
+                    self.caps.learn(sink)
+                self.publish("caps", rates=self.caps.rates(sinks))
+
+                # If Strict Mode is ON, we are ALWAYS in Auto Mode
+                effective_auto = self.auto_mode or self.strict_mode
+                
+                if not effective_auto:
+                    if self.schedulers:
+                        self.schedulers.clear()
+                        self.release_sink_clocks()
+                        self.xruns.set_active(False)
+                        self.verifier.cancel()
+                        self.publish("lock", locks={})
+                        self.publish("sinks", sinks={})
+                    continue
+
+                self.rules.reload_if_changed()
+                streams = []
+                rules = {}
+                for obj in self.backend.nodes(state="running", media_class="Stream/Output/Audio"):
+                    rule = rules[obj['id']] = self.rules.match(obj)
+                    if not rule or rule.action != "ignore":
+                        streams.append(obj)
+                missing = []
+                for obj in streams:
+                    props = obj.get('info', {}).get('props', {})
+                    rule = rules[obj['id']]
+                    if rule and rule.action == "pin":
+                        continue # Known rate, nothing to probe
+                    if not props.get('audio.rate') or not props.get('audio.format'):
+                        missing.append(obj)
+                # Rate/format of streams that don't publish them (Spotify, browsers)
+                dynamic_info = {}
+                if missing:
+                    READ_FORMATS.inc()
+                    dynamic_info = self.backend.read_formats(missing)
+
+                now = time.monotonic()
+                candidates = []
+                for obj in streams:
+                    stream = self.describe_stream(obj, dynamic_info, rules[obj['id']])
+                    if stream: candidates.append(stream)
+                for node_id in list(self.started_at):
+                    if not any(s['id'] == node_id for s in candidates):
+                        del self.started_at[node_id]
+                for stream in candidates:
+                    self.started_at.setdefault(stream['id'], now)
+
+                # Each sink (driver group) gets its own decision
+                groups = {}
+                for stream in candidates:
+                    groups.setdefault(stream['driver'], []).append(stream)
+
+                changed = False
+                winners = []
+                for driver in set(groups) | set(self.schedulers):
+                    scheduler = self.schedulers.get(driver)
+                    if scheduler is None:
+                        scheduler = self.schedulers[driver] = SwitchScheduler()
+                    action, winner = scheduler.update(groups.get(driver, []), now)
+                    if action == "apply":
+                        mapped = f" (stream {winner['stream_rate']}Hz)" if winner['stream_rate'] != winner['rate'] else ""
+                        print(f"[System] Locked {self.sink_name(driver)} to {winner['app']}: {winner['rate']}Hz{mapped}")
+                        changed = True
+                        started = self.started_at.pop(winner['id'], None)
+                        if started is not None:
+                            TIME_TO_SWITCH.observe(now - started)
+                    elif action == "idle" or (action is None and scheduler.current is None and not scheduler.wake_at):
+                        del self.schedulers[driver]
+                        changed = changed or action == "idle"
+                    if scheduler.current is not None and scheduler.holder:
+                        # What the clock is at, not a switch still waiting
+                        # out its coalesce window or family dwell
+                        winners.append(dict(scheduler.holder, rate=scheduler.current[0]))
+
+                if changed:
+                    self.apply_clocks()
+                # The profiler feed is only read while some sink holds a clock
+                self.xruns.set_active(any(s.current for s in self.schedulers.values()))
+                self.verify_switches()
+
+                if winners:
+                    # The window follows the oldest stream that holds a clock
+                    winner = min(winners, key=lambda w: (w['serial'], w['id']))
+                    self.publish("stream", rate=winner['rate'], app=winner['app'],
+                                 format=str(winner['format']), latency=winner['latency'], status="Playing")
+
+                SCAN_SECONDS.observe(time.perf_counter() - scan_start)
+
+            except Exception as e:
+                EXCEPTIONS.inc(where="monitor")
+                print(f"[Error] {e}")
+                time.sleep(5)
+
+    def sink_name(self, driver):
+        node = self.backend.graph.get(driver) if driver is not None else None
+        props = ((node or {}).get('info') or {}).get('props') or {}
+        return props.get('node.description') or props.get('node.name') or "default sink"
+
+    def apply_clocks(self):
+        # Turns the per-sink targets into clock writes. While every active sink
+        # wants the same thing the global settings are enough. When they
+        # disagree the global force is released and each driver is forced on
+        # its own, so no DAC gets resampled for another DAC's stream.
+        targets = {d: (s.current[0], self.quantum.target(d, s.current[1]))
+                   for d, s in self.schedulers.items() if s.current}
+        self.publish("sinks", sinks={self.sink_name(d): int(r) for d, (r, q) in targets.items()})
+        if not targets:
+            print("[System] Idle confirmed.")
+            self.current_rate = "Unknown"
+            self.publish("idle", rate=None, app=None, format=None, latency=None, status="Idle", xruns=None)
+            self.backend.set_clock({"clock.force-quantum": 0})
+            self.release_sink_clocks()
+            self.verifier.cancel()
+            return
+
+        # Every write becomes a transaction the verifier follows up on
+        now = time.monotonic()
+        for driver in list(self.verifier.transactions):
+            if driver not in targets:
+                self.verifier.cancel(driver)
+
+        if len(set(targets.values())) == 1:
+            rate, quantum = next(iter(targets.values()))
+            self.release_sink_clocks()
+            self.apply_rate(rate, quantum)
+            self.history.record(history.SWITCH, rate=rate, quantum=self.valid_quantum(quantum))
+            for driver in targets:
+                if driver is not None:
+                    self.verifier.begin(driver, rate, self.valid_quantum(quantum), now)
+            return
+
+        try:
+            self.backend.set_clock({"clock.force-rate": 0, "clock.force-quantum": 0})
+            for driver, (rate, quantum) in targets.items():
+                if driver is None:
+                    continue # Not linked to a sink yet, nothing to force
+                if self.backend.set_driver_clock(driver, rate, self.valid_quantum(quantum)):
+                    print(f"[System] {self.sink_name(driver)}: {rate}Hz")
+                    STARTUP.mark("first_switch")
+                    self.history.record(history.SWITCH, rate=rate, quantum=self.valid_quantum(quantum),
+                                        app=self.sink_name(driver))
+                self.verifier.begin(driver, rate, self.valid_quantum(quantum), now)
+            for driver in list(self.backend.driver_clocks):
+                if driver not in targets:
+                    self.backend.set_driver_clock(driver, 0, 0)
+            self.current_rate = "Per-sink"
+        except Exception as e:
+            EXCEPTIONS.inc(where="apply_clocks")
+            print(f"[Error] {e}")
+
+    def on_xrun_sample(self, samples):
+        # From the pw-top reader thread: {driver id: (errors, busy, rate, quantum)}
+        now = time.monotonic()
+        for driver, (errors, busy, rate, quantum) in samples.items():
+            self.reported[driver] = (rate, quantum)
+            scheduler = self.schedulers.get(driver)
+            # Only forced quanta (Strict Mode, "strict" rules) get adapted
+            adapt = bool(scheduler and scheduler.current and scheduler.current[1])
+            step = self.quantum.feed(driver, errors, busy, now, adapt=adapt)
+            if step:
+                quantum = self.quantum.target(driver, scheduler.current[1])
+                print(f"[System] {self.sink_name(driver)}: quantum {step} to {quantum} "
+                      f"({'xruns' if step == 'raised' else 'stable'})")
+                self.retune = True
+                self.wakeup.set()
+        self.publish("xruns", xruns=round(self.quantum.xrun_rate(now), 1))
+        if self.verifier.wake_at is not None:
+            self.wakeup.set() # Fresh rates for a switch still waiting to lock
+
+    def verify_switches(self):
+        # Matches what the drivers report against the writes still pending,
+        # repeats writes that didn't take and tells the listeners
+        now = time.monotonic()
+        for driver, tx in list(self.verifier.transactions.items()):
+            name = self.sink_name(driver)
+            before = tx.status
+            node = self.backend.graph.get(driver)
+            found = format_from_params((node or {}).get('info') or {})
+            if found:
+                self.verifier.observe(driver, int(found[0]), None, now, name)
+            reported = self.reported.pop(driver, None)
+            if reported:
+                self.verifier.observe(driver, reported[0], reported[1], now, name)
+            if tx.status == "locked" and before != "locked":
+                print(f"[System] {name} locked to {tx.rate}Hz in {tx.lock_time * 1000:.0f} ms")
+                STARTUP.mark("first_lock")
+
+        for tx, action in self.verifier.check(now):
+            name = self.sink_name(tx.driver)
+            if action == "retry":
+                print(f"[System] {name} still at {tx.seen[0]}Hz, writing {tx.rate}Hz again (try {tx.attempts})")
+                self.rewrite_clock(tx)
+            elif action == "rejected":
+                print(f"[System] {name} rejected {tx.rate}Hz, stays at {tx.seen[0]}Hz")
+                self.history.record(history.REJECTED, rate=tx.rate, quantum=tx.quantum, app=name)
+
+        self.publish("lock", locks={
+            self.sink_name(tx.driver): {"status": tx.status,
+                                        "ms": round(tx.lock_time * 1000) if tx.lock_time is not None else None}
+            for tx in self.verifier.transactions.values()})
+
+    def rewrite_clock(self, tx):
+        quantum = self.valid_quantum(tx.quantum)
+        try:
+            if tx.driver in self.backend.driver_clocks:
+                self.backend.set_driver_clock(tx.driver, tx.rate, quantum, force=True)
+            else:
+                self.backend.set_clock({"clock.force-rate": tx.rate, "clock.force-quantum": quantum}, force=True)
+        except Exception as e:
+            EXCEPTIONS.inc(where="rewrite_clock")
+            print(f"[Error] {e}")
+
+    def release_sink_clocks(self):
+        try:
+            for driver in list(self.backend.driver_clocks):
+                self.backend.set_driver_clock(driver, 0, 0)
+        except Exception as e:
+            EXCEPTIONS.inc(where="release_sink_clocks")
+            print(f"[Error] {e}")
+
+    def valid_quantum(self, quantum):
+        # Only powers of two PipeWire accepts, anything else means "auto"
+        if quantum > 0 and (quantum & (quantum-1) == 0) and quantum >= 32 and quantum <= 8192:
+            return quantum
+        return 0
+
+    def apply_rate(self, rate, quantum=0):
+        try:
+            quantum = self.valid_quantum(quantum)
+
+            # Only what differs from the live metadata is written
+            with CLOCK_WRITE_SECONDS.time():
+                self.backend.set_clock({"clock.force-rate": rate, "clock.force-quantum": quantum})
+
+            self.current_rate = str(rate)
+            STARTUP.mark("first_switch")
+        except Exception as e:
+            EXCEPTIONS.inc(where="apply_rate")
+            print(f"[Error] Clock write failed: {e}")
@@ -0,0 +1,368 @@
+# ==============================================================================
+# === FLIGHT RECORDER LOG ===
+# ==============================================================================
+# What `scanner.py record` writes: the audio nodes of the graph, the clock
+# settings and the switcher's decisions, as an append-only binary log that
+# can run for weeks. Segments live in ~/.local/state/pw-rate-switcher/flight:
+#
+#   flight-<start time>.log   records
+#   flight-<start time>.idx   time index: (time float64, keyframe offset uint64)
+#
+# A record is  varint(ms since the previous record) | kind byte | body.
+# Only what changed is written: a NODE record carries the fields of one node
+# that differ from its last record, a CLOCK / DECISION record the settings
+# that differ. Every few minutes (and at the start of each segment) a
+# KEYFRAME holds the complete state with an absolute time, and its offset goes
+# into the index. A lookup bisects the index through mmap, jumps to the last
+# keyframe before the time asked for and decodes forward from there.
+#
+# Segments rotate at `max_bytes`, the oldest are deleted past `max_segments`.
+# A record cut short by a crash ends the segment, nothing before it is lost.
+
+import bisect
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+
+KEYFRAME = 0
+NODE = 1     # Fields of one node that changed
+GONE = 2     # Node removed
+CLOCK = 3    # clock.* settings that changed
+DECISION = 4 # Switcher state that changed (from the control socket)
+
+NODE_FIELDS = ("media.class", "node.name", "node.description", "application.name", "state",
+               "audio.rate", "audio.format", "node.rate", "node.latency", "format", "driver")
+CLOCK_FIELDS = ("clock.force-rate", "clock.force-quantum", "clock.rate", "clock.quantum")
+DECISION_FIELDS = ("event", "mode", "rate", "app", "format", "status", "sinks", "locks")
+
+MAGIC = b"PWFLT1\n"
+_INDEX = struct.Struct("<dQ")
+_TIME = struct.Struct("<d")
+_REMOVED = 0x80 # Field index flag: the field is gone, no value follows
+
+
+def log_dir():
+    base = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(base, "pw-rate-switcher", "flight")
+
+
+def segments(directory):
+    # [(start time, log path)], oldest first
+    found = []
+    for path in glob.glob(os.path.join(directory, "flight-*.log")):
+        try:
+            found.append((int(os.path.basename(path)[7:-4]), path))
+        except ValueError:
+            pass
+    return sorted(found)
+
+
+# --- Encoding ---
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _encode_fields(names, old, new, out):
+    # Fields of `new` that differ from `old` (missing ones count as removed)
+    changes = []
+    for i, name in enumerate(names):
+        value = new.get(name)
+        if value != old.get(name):
+            changes.append((i, value))
+    _varint(len(changes), out)
+    for i, value in changes:
+        if value is None:
+            out.append(i | _REMOVED)
+        else:
+            data = str(value).encode()
+            out.append(i)
+            _varint(len(data), out)
+            out += data
+    return bool(changes)
+
+
+def _decode_fields(names, buf, pos, fields):
+    count, pos = _read_varint(buf, pos)
+    for _ in range(count):
+        i = buf[pos]
+        pos += 1
+        if i & _REMOVED:
+            fields.pop(names[i & ~_REMOVED], None)
+            continue
+        size, pos = _read_varint(buf, pos)
+        fields[names[i]] = bytes(buf[pos:pos + size]).decode(errors="replace")
+        pos += size
+    return pos
+
+
+# --- Writing ---
+
+class FlightLog:
+    def __init__(self, directory=None, max_bytes=8 << 20, max_segments=8, keyframe_every=300.0):
+        self.directory = directory or log_dir()
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self.keyframe_every = keyframe_every
+        self.lock = threading.Lock()
+        self.nodes = {}     # id -> fields as last written
+        self.clock = {}
+        self.decision = {}
+        self.log = self.index = None
+        self.last_time = 0.0     # Time of the last record, as the reader will see it
+        self.last_keyframe = 0.0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def close(self):
+        with self.lock:
+            self._close_segment()
+
+    def update_nodes(self, nodes, now=None):
+        # nodes: {id: {field: value}} for every audio node there is now
+        now = time.time() if now is None else now
+        with self.lock:
+            self._begin(now)
+            out = bytearray()
+            for node_id, fields in nodes.items():
+                body = bytearray()
+                _varint(node_id, body)
+                if _encode_fields(NODE_FIELDS, self.nodes.get(node_id, {}), fields, body):
+                    self._record(out, NODE, body, now)
+                    self.nodes[node_id] = dict(fields)
+            for node_id in [i for i in self.nodes if i not in nodes]:
+                body = bytearray()
+                _varint(node_id, body)
+                self._record(out, GONE, body, now)
+                del self.nodes[node_id]
+            self._write(out)
+
+    def update_clock(self, settings, now=None):
+        self._update(CLOCK, CLOCK_FIELDS, "clock", settings, now)
+
+    def update_decision(self, state, now=None):
+        self._update(DECISION, DECISION_FIELDS, "decision", state, now)
+
+    def _update(self, kind, names, attr, fields, now):
+        now = time.time() if now is None else now
+        with self.lock:
+            self._begin(now)
+            body = bytearray()
+            if _encode_fields(names, getattr(self, attr), fields, body):
+                out = bytearray()
+                self._record(out, kind, body, now)
+                setattr(self, attr, {k: str(v) for k, v in fields.items() if k in names and v is not None})
+                self._write(out)
+
+    def _begin(self, now):
+        # Before any record of an update: a new segment or a keyframe when due
+        if self.log is None or self.log.tell() >= self.max_bytes:
+            self._rotate(now)
+        elif now - self.last_keyframe >= self.keyframe_every:
+            self._keyframe(now)
+
+    def _record(self, out, kind, body, now):
+        delta = max(0, round((now - self.last_time) * 1000))
+        self.last_time += delta / 1000.0 # What the reader will add up, no drift
+        _varint(delta, out)
+        out.append(kind)
+        out += body
+
+    def _write(self, out):
+        if out:
+            self.log.write(out)
+            self.log.flush()
+
+    def _keyframe(self, now):
+        offset = self.log.tell()
+        self.last_time = self.last_keyframe = now
+        body = bytearray(_TIME.pack(now))
+        _varint(len(self.nodes), body)
+        for node_id, fields in self.nodes.items():
+            _varint(node_id, body)
+            _encode_fields(NODE_FIELDS, {}, fields, body)
+        _encode_fields(CLOCK_FIELDS, {}, self.clock, body)
+        _encode_fields(DECISION_FIELDS, {}, self.decision, body)
+        self.log.write(b"\0" + bytes([KEYFRAME]) + body)
+        self.log.flush()
+        self.index.write(_INDEX.pack(now, offset))
+        self.index.flush()
+
+    def _rotate(self, now):
+        self._close_segment()
+        start = int(now)
+        while os.path.exists(os.path.join(self.directory, f"flight-{start:010d}.log")):
+            start += 1 # Rotated twice within a second
+        base = os.path.join(self.directory, f"flight-{start:010d}")
+        self.log = open(base + ".log", "ab")
+        self.index = open(base + ".idx", "ab")
+        self.log.write(MAGIC)
+        # A new segment has to stand on its own: it opens with everything
+        self._keyframe(now)
+        for _, path in segments(self.directory)[:-self.max_segments]:
+            for name in (path, path[:-4] + ".idx"):
+                try:
+                    os.unlink(name)
+                except OSError:
+                    pass
+
+    def _close_segment(self):
+        for f in (self.log, self.index):
+            if f:
+                f.close()
+        self.log = self.index = None
+
+
+# --- Reading ---
+
+class Snapshot:
+    # State of the graph and the switcher at one point of a replay
+    def __init__(self):
+        self.time = 0.0
+        self.nodes = {}
+        self.clock = {}
+        self.decision = {}
+
+
+class SegmentReader:
+    def __init__(self, path):
+        self.path = path
+        self.data = self.keys = None
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size > len(MAGIC):
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with open(path[:-4] + ".idx", "rb") as f:
+                if os.fstat(f.fileno()).st_size >= _INDEX.size:
+                    self.keys = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            pass
+
+    def close(self):
+        for m in (self.data, self.keys):
+            if m:
+                m.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def keyframe_before(self, when):
+        # Offset of the last keyframe at or before `when` (the first one if
+        # `when` is earlier than the segment), bisected straight on the mmap
+        if not self.keys:
+            return len(MAGIC)
+        count = len(self.keys) // _INDEX.size
+        times = _IndexTimes(self.keys, count)
+        i = max(bisect.bisect_right(times, when) - 1, 0)
+        return _INDEX.unpack_from(self.keys, i * _INDEX.size)[1]
+
+    def replay(self, offset, snapshot, until=None):
+        # Applies records from the keyframe at `offset` to `snapshot` up to
+        # time `until`, yields (kind, node id or None, fields before) after each
+        data = self.data
+        if data is None or data[:len(MAGIC)] != MAGIC:
+            return
+        pos = offset
+        try:
+            while pos < len(data):
+                delta, pos = _read_varint(data, pos)
+                kind = data[pos]
+                pos += 1
+                when = _TIME.unpack_from(data, pos)[0] if kind == KEYFRAME else snapshot.time + delta / 1000.0
+                if until is not None and when > until:
+                    return
+                snapshot.time = when
+                if kind == KEYFRAME:
+                    pos += _TIME.size
+                    count, pos = _read_varint(data, pos)
+                    snapshot.nodes = {}
+                    for _ in range(count):
+                        node_id, pos = _read_varint(data, pos)
+                        snapshot.nodes[node_id] = {}
+                        pos = _decode_fields(NODE_FIELDS, data, pos, snapshot.nodes[node_id])
+                    snapshot.clock, snapshot.decision = {}, {}
+                    pos = _decode_fields(CLOCK_FIELDS, data, pos, snapshot.clock)
+                    pos = _decode_fields(DECISION_FIELDS, data, pos, snapshot.decision)
+                    yield kind, None, None
+                elif kind == NODE:
+                    node_id, pos = _read_varint(data, pos)
+                    before = snapshot.nodes.get(node_id, {})
+                    fields = snapshot.nodes[node_id] = dict(before)
+                    pos = _decode_fields(NODE_FIELDS, data, pos, fields)
+                    yield kind, node_id, before
+                elif kind == GONE:
+                    node_id, pos = _read_varint(data, pos)
+                    yield kind, node_id, snapshot.nodes.pop(node_id, {})
+                elif kind in (CLOCK, DECISION):
+                    names, fields = ((CLOCK_FIELDS, snapshot.clock) if kind == CLOCK
+                                     else (DECISION_FIELDS, snapshot.decision))
+                    before = dict(fields)
+                    pos = _decode_fields(names, data, pos, fields)
+                    yield kind, None, before
+                else:
+                    return # Not ours: stop rather than guess
+        except (IndexError, struct.error):
+            return # Cut short by a crash
+
+
+class _IndexTimes:
+    # The time column of an index mmap as a sequence, for bisect
+    def __init__(self, keys, count):
+        self.keys = keys
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return _INDEX.unpack_from(self.keys, i * _INDEX.size)[0]
+
+
+def _segments_between(directory, start, end):
+    found = segments(directory)
+    for n, (begin, path) in enumerate(found):
+        following = found[n + 1][0] if n + 1 < len(found) else None
+        if begin <= end and (following is None or following > start):
+            yield path
+
+
+def state_at(directory, when):
+    # Snapshot of everything recorded as of `when`, None if nothing was
+    found = None
+    for path in _segments_between(directory, when, when):
+        with SegmentReader(path) as reader:
+            snapshot = Snapshot()
+            for _ in reader.replay(reader.keyframe_before(when), snapshot, until=when):
+                found = snapshot
+    return found
+
+
+def events(directory, start, end):
+    # (time, kind, node id, fields before, snapshot after) for every record
+    # between `start` and `end`, oldest first
+    for path in _segments_between(directory, start, end):
+        with SegmentReader(path) as reader:
+            snapshot = Snapshot()
+            for kind, node_id, before in reader.replay(reader.keyframe_before(start), snapshot, until=end):
+                if snapshot.time >= start and kind != KEYFRAME:
+                    yield snapshot.time, kind, node_id, before, snapshot
+
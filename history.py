@@ -0,0 +1,105 @@
+# ==============================================================================
+# === RATE HISTORY ===
+# ==============================================================================
+# What the clock did over the last hours, for the timeline in the window and
+# the "history" control command. A fixed number of entries in flat arrays
+# (about 30 bytes each, no per-entry objects), the oldest overwritten first,
+# so a daemon that runs for months uses the same memory as on day one.
+#
+# App names and formats are interned: each entry stores a small index into a
+# string table, which is rebuilt from the live entries when it fills up.
+
+import threading
+import time
+from array import array
+
+# Entry kinds
+CHANGE = 0   # Rate / app / format / latency changed
+SWITCH = 1   # A clock write went out (app = the sink, for per-sink writes)
+IDLE = 2     # Clock released
+REJECTED = 3 # A driver did not follow a switch (app = the sink)
+KINDS = ("change", "switch", "idle", "rejected")
+
+MAX_STRINGS = 1024
+
+
+class History:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.times = array('d', bytes(8 * capacity))
+        self.rates = array('I', bytes(4 * capacity))
+        self.quanta = array('H', bytes(2 * capacity))
+        self.latency = array('f', bytes(4 * capacity)) # ms, 0 = unknown
+        self.apps = array('H', bytes(2 * capacity))
+        self.formats = array('H', bytes(2 * capacity))
+        self.kinds = array('B', bytes(capacity))
+        self.next = 0  # Slot the next entry goes to
+        self.count = 0
+        self.strings = [""]       # Index 0 is "nothing"
+        self.string_ids = {"": 0}
+
+    def intern(self, text):
+        text = text or ""
+        index = self.string_ids.get(text)
+        if index is None:
+            if len(self.strings) >= MAX_STRINGS:
+                self._compact_strings()
+            index = len(self.strings)
+            self.strings.append(text)
+            self.string_ids[text] = index
+        return index
+
+    def record(self, kind, rate=0, quantum=0, latency=0.0, app="", fmt="", now=None):
+        with self.lock:
+            i = self.next
+            self.times[i] = time.time() if now is None else now
+            self.rates[i] = int(rate or 0)
+            self.quanta[i] = min(int(quantum or 0), 0xFFFF)
+            self.latency[i] = float(latency or 0.0)
+            self.apps[i] = self.intern(app)
+            self.formats[i] = self.intern(fmt)
+            self.kinds[i] = kind
+            self.next = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def since(self, start):
+        # Entries at or after `start` (wall clock), oldest first, as tuples of
+        # (time, kind, rate, quantum, latency ms, app, format)
+        with self.lock:
+            first = (self.next - self.count) % self.capacity
+            out = []
+            for n in range(self.count):
+                i = (first + n) % self.capacity
+                if self.times[i] >= start:
+                    out.append((self.times[i], KINDS[self.kinds[i]], self.rates[i], self.quanta[i],
+                                round(self.latency[i], 1), self.strings[self.apps[i]],
+                                self.strings[self.formats[i]]))
+            return out
+
+    def last(self):
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.next - 1) % self.capacity
+            return self.times[i], KINDS[self.kinds[i]], self.rates[i]
+
+    def _compact_strings(self):
+        # Keep only the strings live entries still point to
+        first = (self.next - self.count) % self.capacity
+        live = {0}
+        for n in range(self.count):
+            i = (first + n) % self.capacity
+            live.add(self.apps[i])
+            live.add(self.formats[i])
+        remap = {}
+        strings = []
+        for old in sorted(live):
+            remap[old] = len(strings)
+            strings.append(self.strings[old])
+        for n in range(self.count):
+            i = (first + n) % self.capacity
+            self.apps[i] = remap[self.apps[i]]
+            self.formats[i] = remap[self.formats[i]]
+        self.strings = strings
+        self.string_ids = {text: index for index, text in enumerate(strings)}
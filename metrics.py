@@ -0,0 +1,348 @@
+# ==============================================================================
+# === METRICS ===
+# ==============================================================================
+# Counters and histograms for the detection loop, rendered in the Prometheus
+# text format. Everything registers on the module-level METRICS registry;
+# values that live elsewhere (cache hits, bytes read) are pulled in through
+# collectors when the text is rendered.
+#
+# Read them with {"cmd": "metrics"} on the control socket, or let
+# --metrics-file write them for node_exporter's textfile collector.
+#
+# Profiler runs cProfile (and tracemalloc when asked) on the monitor thread
+# for a few seconds and writes a report, so a slow install can be looked at
+# without restarting anything.
+#
+# STARTUP records when the process reached its milestones (first clock
+# write, first verified lock, window shown), counted from the exec, and
+# the RSS of the process and everything it started (tray, pw-* tools).
+
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PREFIX = "pw_rate_switcher_"
+
+# Seconds, from "a few ms" (metadata write) to "one pw-cli deadline and more"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    # Label values come from device descriptions: quote them as the text format wants
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(labels.get(n, "") for n in self.label_names), 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield self.name, _labels(self.label_names, key), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {} # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self.lock:
+            row = self.values.get(key)
+            if row is None:
+                row = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        for key, row in items:
+            names = self.label_names + ("le",)
+            for bound, count in zip(self.buckets, row):
+                yield self.name + "_bucket", _labels(names, key + (repr(bound),)), count
+            yield self.name + "_bucket", _labels(names, key + ("+Inf",)), row[-1]
+            yield self.name + "_sum", _labels(self.label_names, key), row[-2]
+            yield self.name + "_count", _labels(self.label_names, key), row[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(PREFIX + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(PREFIX + name, help, labels, buckets))
+
+    def _add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        # collector() yields (name, kind, help, value), kind "counter" / "gauge"
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_number(value)}")
+        for collector in collectors:
+            try:
+                for name, kind, help, value in collector():
+                    lines.append(f"# HELP {PREFIX}{name} {help}")
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                    lines.append(f"{PREFIX}{name} {_number(value)}")
+            except Exception as e:
+                lines.append(f"# collector failed: {e}")
+        return "\n".join(lines) + "\n"
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+METRICS = Registry()
+
+# Shared by every module that starts pw-* tools
+SPAWNS = METRICS.counter("spawns_total", "pw-* processes started", labels=("tool",))
+SPAWN_SECONDS = METRICS.histogram(
+    "spawn_seconds", "Time to start a pw-* process (one-shot writes: until they exit)", labels=("tool",))
+EXCEPTIONS = METRICS.counter("exceptions_total", "Exceptions caught and logged", labels=("where",))
+
+
+@contextmanager
+def spawn(tool):
+    # with spawn("pw-metadata"): subprocess.run(...)
+    SPAWNS.inc(tool=tool)
+    with SPAWN_SECONDS.time(tool=tool):
+        yield
+
+
+class MetricsFile(threading.Thread):
+    # Rewrites `path` every `interval` seconds, atomically (textfile collector)
+    def __init__(self, path, interval=15.0, registry=METRICS):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopping = threading.Event()
+
+    def run(self):
+        while True:
+            self.write()
+            if self.stopping.wait(self.interval):
+                return
+
+    def write(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(self.registry.render())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[Metrics] {e}")
+
+    def stop(self):
+        self.stopping.set()
+        self.write()
+
+
+class Profiler:
+    # request() is called from any thread, tick() from the thread to profile
+    # (the monitor loop) at the top of every pass.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wanted = None   # (seconds, memory, path) of a requested run
+        self.profile = None
+        self.until = 0.0
+        self.memory = False
+        self.path = None
+        self.last_report = None
+
+    def request(self, seconds=30.0, memory=False, path=None):
+        path = path or os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp",
+                                    f"pw-rate-switcher-profile-{os.getpid()}.txt")
+        with self.lock:
+            self.wanted = (float(seconds), bool(memory), path)
+        return path
+
+    def active(self):
+        return self.profile is not None
+
+    def tick(self):
+        with self.lock:
+            wanted, self.wanted = self.wanted, None
+        if wanted and self.profile is None:
+            seconds, self.memory, self.path = wanted
+            self.until = time.monotonic() + seconds
+            if self.memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.profile is not None and time.monotonic() >= self.until:
+            self.profile.disable()
+            self.write_report()
+            self.profile = None
+
+    def write_report(self):
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(25)
+        if self.memory and tracemalloc.is_tracing():
+            out.write("\nTop allocations:\n")
+            for stat in tracemalloc.take_snapshot().statistics("lineno")[:25]:
+                out.write(f"{stat}\n")
+            tracemalloc.stop()
+        try:
+            with open(self.path, "w") as f:
+                f.write(out.getvalue())
+            self.last_report = self.path
+            print(f"[Metrics] Profile written to {self.path}")
+        except OSError as e:
+            print(f"[Metrics] {e}")
+
+
+def process_age():
+    # Seconds since this process was started, from /proc
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _IMPORTED
+
+
+def process_tree_rss(root=None):
+    # {pid: (name, RSS in kB)} for `root` (this process) and its descendants
+    root = root or os.getpid()
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                name, rest = f.read().rsplit(")", 1)
+            parents[int(entry)] = (int(rest.split()[1]), name.split("(", 1)[1])
+        except (OSError, ValueError, IndexError):
+            continue # Gone while we looked
+    tree = {root}
+    grew = True
+    while grew:
+        grew = False
+        for pid, (ppid, _) in parents.items():
+            if ppid in tree and pid not in tree:
+                tree.add(pid)
+                grew = True
+    result = {}
+    for pid in sorted(tree):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                rss = next((int(line.split()[1]) for line in f if line.startswith("VmRSS:")), 0)
+        except (OSError, ValueError):
+            continue
+        result[pid] = (parents.get(pid, (0, "?"))[1], rss)
+    return result
+
+
+class StartupReport:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.marks = {} # milestone -> seconds since the exec
+
+    def mark(self, milestone):
+        # Only the first time counts
+        with self.lock:
+            if milestone in self.marks:
+                return
+            self.marks[milestone] = age = process_age()
+        print(f"[Startup] {milestone.replace('_', ' ')} after {age:.2f} s")
+
+    def report(self):
+        with self.lock:
+            marks = {name: round(age, 3) for name, age in self.marks.items()}
+        processes = process_tree_rss()
+        return {
+            "seconds": marks,
+            "processes": [{"pid": pid, "name": name, "rss_kb": rss} for pid, (name, rss) in processes.items()],
+            "total_rss_kb": sum(rss for _, rss in processes.values()),
+        }
+
+    def collect(self):
+        with self.lock:
+            marks = dict(self.marks)
+        for name in ("first_switch", "first_lock"):
+            if name in marks:
+                yield f"startup_{name}_seconds", "gauge", f"From the exec to the {name.replace('_', ' ')}", marks[name]
+        rss = sum(kb for _, kb in process_tree_rss().values())
+        yield "process_tree_rss_bytes", "gauge", "RSS of the switcher and every process it started", rss * 1024
+
+
+_IMPORTED = time.monotonic()
+STARTUP = StartupReport()
+METRICS.add_collector(STARTUP.collect)
@@ -2,11 +2,103 @@
 import sys
 import subprocess
 import threading
-import json
+import math
 import time
-import re
-import os
 import signal
+
+# Installed builds keep the helper modules next to the icons, not in /usr/bin
+sys.path.append("/usr/share/pw-rate-switcher")
+
+def pop_option(argv, name):
+    # Takes "--name value" / "--name=value" out of argv before GTK sees it
+    for i, arg in enumerate(argv):
+        if arg == name and i + 1 < len(argv):
+            value = argv[i + 1]
+            del argv[i:i + 2]
+            return value
+        if arg.startswith(name + "="):
+            del argv[i]
+            return arg.split("=", 1)[1]
+    return None
+
+# ==============================================================================
+# === HEADLESS DAEMON (no GTK) ===
+# ==============================================================================
+# Runs the engine on its own and serves the control socket (see control.py).
+# Nothing from gi gets imported on this path.
+if len(sys.argv) > 1 and sys.argv[1] == "--daemon":
+    from engine import RateEngine
+    from control import ControlServer, ControlError
+    from metrics import MetricsFile
+
+    argv = list(sys.argv)
+    engine = RateEngine(backend=pop_option(argv, "--backend"))
+    if "--strict" in argv:
+        engine.set_strict(True)
+    try:
+        server = ControlServer(engine, path=pop_option(argv, "--socket"))
+    except (ControlError, OSError) as e:
+        print(f"[Daemon] {e}")
+        sys.exit(1)
+
+    metrics_path = pop_option(argv, "--metrics-file")
+    metrics_file = MetricsFile(metrics_path) if metrics_path else None
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+    signal.signal(signal.SIGINT, lambda *args: stopping.set())
+
+    engine.start()
+    server.start()
+    if metrics_file:
+        metrics_file.start()
+    print(f"[Daemon] Listening on {server.path}")
+    stopping.wait()
+
+    print("[Daemon] Stopping.")
+    if metrics_file:
+        metrics_file.stop()
+    server.stop()
+    engine.stop()
+    sys.exit(0)
+
+# ==============================================================================
+# === FAST START (before GTK) ===
+# ==============================================================================
+# Importing GTK4 and Libadwaita and building the window takes a good part of
+# a second on a cold login, and the first track used to play resampled for
+# that long. The engine and the control socket start here instead. The
+# window is only built when it is first shown, and a second launch just
+# asks the running one to show its window.
+engine = server = None
+start_hidden = False
+if not (len(sys.argv) > 1 and sys.argv[1] == "--tray"):
+    from engine import RateEngine
+    from control import ControlServer, ControlClient, ControlError, ping
+
+    start_hidden = "--hidden" in sys.argv # Login autostart: tray only
+    if start_hidden:
+        sys.argv.remove("--hidden")
+    backend = pop_option(sys.argv, "--backend")
+    if ping():
+        try:
+            ControlClient().request("show")
+            sys.exit(0) # Already running with a window, now shown
+        except (OSError, ValueError, ControlError):
+            pass
+        # A --daemon already owns the clock, this window only drives it
+        print("[UI] Attaching to the running daemon.")
+        engine = ControlClient()
+    else:
+        engine = RateEngine(backend=backend)
+        try:
+            server = ControlServer(engine)
+        except (ControlError, OSError) as e:
+            print(f"[UI] Control socket unavailable: {e}")
+        engine.start()
+        if server:
+            server.start()
+
 import gi
 
 # ==============================================================================
@@ -23,8 +115,14 @@ if len(sys.argv) > 1 and sys.argv[1] == "--tray":
         except:
             sys.exit(0)
 
+    from control import ControlClient, ControlError
+
     def open_main_window(source):
-        subprocess.Popen([sys.executable, sys.argv[0]])
+        # The running app shows its window, no new interpreter needed
+        try:
+            ControlClient(timeout=1.0).request("show")
+        except (OSError, ValueError, ControlError):
+            subprocess.Popen([sys.executable, sys.argv[0]])
 
     def quit_all(source):
         Gtk3.main_quit()
@@ -59,25 +157,57 @@ try:
     gi.require_version('Gtk', '4.0')
     gi.require_version('Adw', '1')
 except ValueError:
-    print("Error: GTK4 or Libadwaita not found.")
+    print("Error: GTK4 or Libadwaita not found. Use --daemon to run without a window.")
+    # FAST START already started the engine: its pw-dump / pw-metadata go too
+    if server:
+        server.stop()
+    if engine:
+        engine.stop()
     sys.exit(1)
 
 from gi.repository import Gtk, Adw, GLib
+from caps import STANDARD_RATES
+from metrics import STARTUP
+
+DEFAULT_RATES = [44100, 48000, 88200, 96000, 176400, 192000]
+TIMELINE_HOURS = 3
+
+def set_text(label, text):
+    # Labels only get touched when the text actually changes
+    if label.get_label() != text:
+        label.set_label(text)
 
 class AutoRateSwitcher(Adw.Application):
-    def __init__(self, **kwargs):
+    def __init__(self, engine, server=None, hidden=False, **kwargs):
         super().__init__(application_id='com.eason.RateSwitcher', **kwargs)
-        self.current_rate = "Unknown"
-        self.running = True
-        self.auto_mode = True
-        self.strict_mode = False 
+        self.engine = engine # Already running (or a ControlClient), see FAST START
+        self.server = server
+        self.hidden = hidden
         self.tray_process = None
         self.manual_buttons = [] # Store buttons to disable them later
+        self.shown_rates = None
+        self.syncing = False # Set while the switches follow the engine, not the user
+        self.window = None
+        self.visible = False # No UI work at all while the window is hidden
+        self.timeline_entries = []
+        self.timeline_timer = None
+        if self.server:
+            # "show" from the tray or a second launch
+            self.server.on_show = lambda: GLib.idle_add(self.show_window)
         self.connect('activate', self.on_activate)
+        self.connect('shutdown', self.on_shutdown)
 
     def on_activate(self, app):
         self.start_tray_icon()
-        self.window = Adw.ApplicationWindow(application=app)
+        if self.hidden:
+            # Started for the tray: no window until someone asks for it
+            self.hidden = False
+            self.hold()
+            return
+        self.show_window()
+
+    def build_window(self):
+        self.window = Adw.ApplicationWindow(application=self)
         self.window.set_title("PipeWire Rate Switcher")
         self.window.set_default_size(400, 620)
         self.window.set_icon_name("pw-rate-switcher")
@@ -115,8 +245,25 @@ class AutoRateSwitcher(Adw.Application):
         self.latency_label = Gtk.Label(label="-- ms")
         self.latency_label.add_css_class("card")
         stats_box.append(self.latency_label)
+
+        self.xrun_label = Gtk.Label(label="-- xruns")
+        self.xrun_label.add_css_class("card")
+        self.xrun_label.set_tooltip_text("Buffer underruns per minute on the locked sinks.\nStrict Mode raises the quantum when they show up.")
+        stats_box.append(self.xrun_label)
+
+        self.lock_label = Gtk.Label(label="--")
+        self.lock_label.add_css_class("card")
+        self.lock_label.set_tooltip_text("Whether the DAC actually switched to the requested rate")
+        stats_box.append(self.lock_label)
         
         content.append(stats_box)
+
+        # Rate over the last hours, one step per change
+        self.timeline = Gtk.DrawingArea()
+        self.timeline.set_content_height(48)
+        self.timeline.set_draw_func(self.draw_timeline)
+        self.timeline.set_tooltip_text(f"Sample rate over the last {TIMELINE_HOURS} hours")
+        content.append(self.timeline)
         content.append(Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL))
         
         # 2. STRICT BIT-PERFECT MODE (Master Switch)
@@ -154,210 +301,109 @@ class AutoRateSwitcher(Adw.Application):
         grid_label.add_css_class("heading")
         self.standard_controls_box.append(grid_label)
 
-        grid = Gtk.Grid()
-        grid.set_column_spacing(10)
-        grid.set_row_spacing(10)
-        grid.set_halign(Gtk.Align.CENTER)
-        rates = ["44100", "48000", "88200", "96000", "176400", "192000"]
-        for i, rate in enumerate(rates):
-            btn = Gtk.Button(label=f"{int(rate)//1000} kHz")
-            btn.connect("clicked", self.on_manual_click, rate)
-            btn.set_size_request(100, 40)
-            grid.attach(btn, i % 2, i // 2, 1, 1)
-            self.manual_buttons.append(btn)
+        self.rate_grid = Gtk.Grid()
+        self.rate_grid.set_column_spacing(10)
+        self.rate_grid.set_row_spacing(10)
+        self.rate_grid.set_halign(Gtk.Align.CENTER)
+        self.update_rate_buttons(None)
 
-        self.standard_controls_box.append(grid)
+        self.standard_controls_box.append(self.rate_grid)
         
+        self.engine.add_listener(self.on_engine_change)
+
+    def show_window(self):
+        if self.window is None:
+            self.build_window()
+        self.visible = True
+        # Catch up on whatever happened before or while it was hidden
+        self.on_engine_event("mode", self.engine.snapshot())
+        if self.timeline_timer is None:
+            # Keeps the timeline scrolling while nothing changes
+            self.timeline_timer = GLib.timeout_add_seconds(60, self.refresh_timeline)
         self.window.present()
-        threading.Thread(target=self.monitor_pipewire, daemon=True).start()
+        STARTUP.mark("window_shown")
+        return False
 
     def start_tray_icon(self):
         if self.tray_process is None:
             self.tray_process = subprocess.Popen([sys.executable, sys.argv[0], "--tray"])
+            # Quitting from the tray ends the whole app
+            GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.tray_process.pid, self.on_tray_exit)
 
     def on_window_close_request(self, window):
         print("[UI] Window hidden (Check System Tray)")
+        self.visible = False
+        if self.timeline_timer is not None:
+            GLib.source_remove(self.timeline_timer)
+            self.timeline_timer = None
         window.hide()
         return True
 
+    def on_tray_exit(self, pid, status):
+        self.quit()
+
+    def on_shutdown(self, app):
+        self.engine.stop()
+        if self.server:
+            self.server.stop()
+
+    def on_engine_change(self, event, state):
+        # From the engine (or socket) thread. A hidden window is resynced
+        # from a snapshot when it comes back, so nothing is queued meanwhile.
+        if self.visible or event == "closed":
+            GLib.idle_add(self.on_engine_event, event, state)
+
+    def on_engine_event(self, event, state):
+        if event == "closed":
+            self.update_status("Switcher stopped")
+            return False
+        if event in ("stream", "idle", "lock", "mode"):
+            self.refresh_timeline()
+
+        # Keep the switches in line with the engine (other clients can change it)
+        mode = state["mode"]
+        self.syncing = True
+        self.strict_switch.set_active(mode == "strict")
+        if mode != "strict":
+            self.auto_switch.set_active(mode == "auto")
+        self.syncing = False
+
+        if state["rate"]:
+            self.update_ui(state["rate"], state["app"], state["format"], state["latency"] or "-- ms")
+        else:
+            self.update_status(state["status"])
+        self.update_xruns(state.get("xruns"))
+        self.update_lock(state.get("locks") or {})
+        self.update_rate_buttons(state.get("rates"))
+        return False
+
     def on_strict_toggled(self, switch, state):
-        self.strict_mode = state
-        
         # UI LOGIC: Gray out everything else when Strict Mode is ON
         self.standard_controls_box.set_sensitive(not state)
         
         if state:
-            print("[UI] Strict Mode ON: Taking full control.")
-            # Force Auto Mode ON internally (Strict implies Auto)
-            self.auto_mode = True
             # Visual feedback
             self.rate_label.add_css_class("accent") 
         else:
-            print("[UI] Strict Mode OFF: Restoring controls.")
-            # Restore Auto Mode to whatever the switch says
-            self.auto_mode = self.auto_switch.get_active()
             self.rate_label.remove_css_class("accent")
 
-        # Reset monitoring to force immediate re-scan
-        self.current_rate = "Unknown" 
+        if not self.syncing:
+            self.engine.set_strict(state)
         return False
 
     def on_auto_toggled(self, switch, state):
-        # Only works if Strict Mode is OFF
-        if not self.strict_mode:
-            self.auto_mode = state
+        # Only works if Strict Mode is OFF (the engine checks)
+        if not self.syncing:
+            self.engine.set_auto(state)
         return False
 
     def on_manual_click(self, button, rate):
-        # Only works if Strict Mode is OFF
-        if not self.strict_mode:
-            self.auto_mode = False
-            self.auto_switch.set_active(False)
-            self.apply_rate(rate, 0)
-
-    def get_dynamic_info(self, node_id):
-        rate = None
-        fmt = "Unknown"
-        try:
-            cmd = ["pw-cli", "enum-params", str(node_id), "Format"]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            output = result.stdout.strip()
-            if output:
-                match_rate = re.search(r'rate.*?Int\s+(\d+)', output, re.DOTALL | re.IGNORECASE)
-                if match_rate: rate = match_rate.group(1)
-                
-                match_fmt = re.search(r'AudioFormat:([a-zA-Z0-9]+)', output)
-                if match_fmt: fmt = match_fmt.group(1)
-                else:
-                    match_simple = re.search(r'\((F32LE|S16LE|S24LE|S32LE|S24_32LE)\)', output)
-                    if match_simple: fmt = match_simple.group(1)
-        except: pass
-        return rate, fmt
-
-    def monitor_pipewire(self):
-        idle_counter = 0
-        MAX_IDLE_CYCLES = 3 
-        
-        while self.running:
-            if self.tray_process and self.tray_process.poll() is not None:
-                self.running = False
-                self.quit()
-                sys.exit(0)
-
-            try:
-                # If Strict Mode is ON, we are ALWAYS in Auto Mode
-                effective_auto = self.auto_mode or self.strict_mode
-                
-                if not effective_auto:
-                    time.sleep(1)
-                    continue
-
-                result = subprocess.run(['pw-dump'], capture_output=True, text=True)
-                if result.stdout:
-                    data = json.loads(result.stdout)
-                    target_rate = None
-                    target_quantum = 0 # 0 means Auto
-                    active_app_name = None
-                    active_format = "--"
-                    active_latency = "--"
-
-                    for obj in data:
-                        if obj.get('type') != 'PipeWire:Interface:Node': continue
-                            
-                        props = obj.get('info', {}).get('props', {})
-                        state = obj.get('info', {}).get('state', '').lower()
-                        media_class = props.get('media.class', '')
-                        node_id = obj.get('id')
-                        name = props.get('node.name', 'Unknown')
-                        app_name = props.get('application.name', name)
-
-                        if state == "running" and "Stream/Output/Audio" in media_class:
-                            rate = None
-                            fmt = props.get('audio.format')
-                            
-                            if props.get('audio.rate'): rate = props.get('audio.rate')
-
-                            if not rate:
-                                node_rate = props.get('node.rate')
-                                if node_rate and isinstance(node_rate, str):
-                                    if '/' in node_rate:
-                                        try:
-                                            denom = node_rate.split('/')[1].strip()
-                                            if denom.isdigit(): rate = denom
-                                        except: pass
-                                    elif node_rate.strip().isdigit():
-                                        rate = node_rate.strip()
-
-                            if not rate or str(rate) == "0" or not fmt or fmt == "Unknown":
-                                dyn_rate, dyn_fmt = self.get_dynamic_info(node_id)
-                                if not rate or str(rate) == "0": rate = dyn_rate
-                                if dyn_fmt != "Unknown": fmt = dyn_fmt
-                                
-                            lat_str = props.get('node.latency')
-                            current_quantum = 0
-                            latency_ms = "-- ms"
-                            
-                            if lat_str and '/' in str(lat_str):
-                                try:
-                                    parts = str(lat_str).split('/')
-                                    samples = float(parts[0])
-                                    freq = float(parts[1])
-                                    ms = (samples / freq) * 1000
-                                    latency_ms = f"{ms:.1f} ms"
-                                    current_quantum = int(samples)
-                                except: pass
-
-                            if rate and str(rate).isdigit() and int(rate) > 0:
-                                target_rate = rate
-                                target_quantum = current_quantum
-                                active_app_name = app_name
-                                active_format = fmt
-                                active_latency = latency_ms
-                                break 
-                    
-                    if target_rate:
-                        idle_counter = 0
-                        rate_changed = (target_rate != self.current_rate)
-                        
-                        # In strict mode, we always re-apply if quantum changes
-                        if rate_changed or self.strict_mode:
-                            quantum_to_set = target_quantum if self.strict_mode else 0
-                            print(f"[System] Locked to {active_app_name}: {target_rate}Hz")
-                            self.apply_rate(target_rate, quantum_to_set)
-                        
-                        GLib.idle_add(self.update_ui, str(target_rate), active_app_name, str(active_format), str(active_latency))
-                    
-                    else:
-                        idle_counter += 1
-                        if idle_counter >= MAX_IDLE_CYCLES:
-                            if self.current_rate != "Unknown":
-                                print("[System] Idle confirmed.")
-                                self.current_rate = "Unknown"
-                                GLib.idle_add(self.update_status, "Idle")
-                                subprocess.run(["pw-metadata", "-n", "settings", "0", "clock.force-quantum", "0"])
-                
-                time.sleep(1.5)
-
-            except Exception as e:
-                print(f"[Error] {e}")
-                time.sleep(5)
-
-    def apply_rate(self, rate, quantum=0):
-        try:
-            subprocess.run(["pw-metadata", "-n", "settings", "0", "clock.force-rate", str(rate)])
-            
-            if quantum > 0 and (quantum & (quantum-1) == 0) and quantum >= 32 and quantum <= 8192:
-                 subprocess.run(["pw-metadata", "-n", "settings", "0", "clock.force-quantum", str(quantum)])
-            else:
-                 subprocess.run(["pw-metadata", "-n", "settings", "0", "clock.force-quantum", "0"])
-
-            self.current_rate = str(rate)
-        except Exception as e:
-            pass
+        # Only works if Strict Mode is OFF, turns Auto off
+        self.engine.set_manual_rate(rate)
 
     def update_ui(self, rate, app_name, fmt, latency):
-        self.rate_label.set_label(f"{rate} Hz")
-        self.status_label.set_label(f"{app_name}")
+        set_text(self.rate_label, f"{rate} Hz")
+        set_text(self.status_label, f"{app_name}")
         
         if fmt == "F32LE": fmt_text = "32-bit Float"
         elif fmt == "S32LE": fmt_text = "32-bit Int"
@@ -366,17 +412,114 @@ class AutoRateSwitcher(Adw.Application):
         elif fmt == "S24_32LE": fmt_text = "24/32-bit"
         else: fmt_text = fmt if fmt else "Unknown"
         
-        self.bit_depth_label.set_label(f" {fmt_text} ")
-        self.latency_label.set_label(f" {latency} ")
+        set_text(self.bit_depth_label, f" {fmt_text} ")
+        set_text(self.latency_label, f" {latency} ")
+        return False
+
+    def update_rate_buttons(self, supported):
+        # Only rates the connected DACs can take, the classic six until they are known
+        rates = [r for r in STANDARD_RATES if supported and r in supported] or DEFAULT_RATES
+        if rates == self.shown_rates:
+            return
+        self.shown_rates = rates
+        for btn in self.manual_buttons:
+            self.rate_grid.remove(btn)
+        self.manual_buttons = []
+        for i, rate in enumerate(rates):
+            btn = Gtk.Button(label=f"{int(rate)//1000} kHz")
+            btn.connect("clicked", self.on_manual_click, str(rate))
+            btn.set_size_request(100, 40)
+            self.rate_grid.attach(btn, i % 2, i // 2, 1, 1)
+            self.manual_buttons.append(btn)
+
+    def update_lock(self, locks):
+        # Worst sink wins: rejected > pending > unverified > locked
+        statuses = [lock["status"] for lock in locks.values()]
+        if "rejected" in statuses:
+            set_text(self.lock_label, " Rejected by device ")
+            self.lock_label.add_css_class("error")
+            return False
+        self.lock_label.remove_css_class("error")
+        if "pending" in statuses:
+            set_text(self.lock_label, " Locking... ")
+        elif "unverified" in statuses:
+            set_text(self.lock_label, " Unverified ")
+        elif statuses:
+            slowest = max(lock["ms"] or 0 for lock in locks.values())
+            set_text(self.lock_label, f" Locked ({slowest} ms) ")
+        else:
+            set_text(self.lock_label, "--")
+        return False
+
+    def update_xruns(self, rate):
+        if rate is None:
+            set_text(self.xrun_label, "-- xruns")
+            self.xrun_label.remove_css_class("error")
+            return False
+        set_text(self.xrun_label, f" {rate:g} xruns/min ")
+        if rate > 0: self.xrun_label.add_css_class("error")
+        else: self.xrun_label.remove_css_class("error")
         return False
 
     def update_status(self, text):
-        self.status_label.set_label(text)
-        self.rate_label.set_label("Scanning...")
-        self.bit_depth_label.set_label("--")
-        self.latency_label.set_label("--")
+        set_text(self.status_label, text)
+        set_text(self.rate_label, "Scanning...")
+        set_text(self.bit_depth_label, "--")
+        set_text(self.latency_label, "--")
         return False
 
+    def refresh_timeline(self):
+        if not self.visible:
+            return True
+        try:
+            entries = self.engine.history_since(TIMELINE_HOURS * 3600)
+        except (ControlError, OSError):
+            entries = []
+        if entries != self.timeline_entries:
+            self.timeline_entries = entries
+            self.timeline.queue_draw()
+        elif entries:
+            self.timeline.queue_draw() # Same steps, but the time axis moved on
+        return True
+
+    def draw_timeline(self, area, cr, width, height):
+        # Rate as a step line on a log scale (44.1k at the bottom, 384k at the
+        # top), gaps while idle, red ticks where a DAC rejected a switch
+        end = time.time()
+        start = end - TIMELINE_HOURS * 3600
+        low, high = math.log2(STANDARD_RATES[0]), math.log2(STANDARD_RATES[-1])
+        def x_of(t): return (max(t, start) - start) / (end - start) * width
+        def y_of(rate):
+            level = math.log2(min(max(rate, STANDARD_RATES[0]), STANDARD_RATES[-1]))
+            return height - 4 - (level - low) / (high - low) * (height - 8)
+
+        color = area.get_color() if hasattr(area, "get_color") else None
+        rgb = (color.red, color.green, color.blue) if color else (0.5, 0.5, 0.5)
+        cr.set_source_rgba(*rgb, 0.15)
+        cr.rectangle(0, height - 1, width, 1)
+        cr.fill()
+
+        cr.set_source_rgba(*rgb, 0.9)
+        cr.set_line_width(2)
+        rate, since = 0, start
+        for t, kind, entry_rate, quantum, latency, app, fmt in self.timeline_entries:
+            if kind not in ("change", "idle"):
+                continue
+            if rate:
+                cr.move_to(x_of(since), y_of(rate))
+                cr.line_to(x_of(t), y_of(rate))
+            rate, since = (entry_rate if kind == "change" else 0), t
+        if rate:
+            cr.move_to(x_of(since), y_of(rate))
+            cr.line_to(width, y_of(rate))
+        cr.stroke()
+
+        cr.set_source_rgba(0.9, 0.2, 0.2, 0.9)
+        for t, kind, *rest in self.timeline_entries:
+            if kind == "rejected":
+                cr.rectangle(x_of(t) - 1, 0, 2, height)
+        cr.fill()
+
 if __name__ == "__main__":
-    app = AutoRateSwitcher()
+    app = AutoRateSwitcher(engine, server, hidden=start_hidden)
     app.run(sys.argv)
@@ -0,0 +1,225 @@
+# ==============================================================================
+# === PERSISTENT PW-CLI SESSION ===
+# ==============================================================================
+# Streams like Spotify or browsers never publish audio.rate / audio.format, so
+# their negotiated Format has to be asked for with `enum-params <id> Format`.
+# Instead of spawning pw-cli for every question, one interactive pw-cli stays
+# open and requests are written to its stdin. In interactive mode pw-cli tags
+# every param it prints with the object id, which is how the replies are
+# matched back to the node that asked. Results are cached per node.
+#
+# Replies arrive asynchronously, after the server round trip, so they are only
+# ever matched by that id header. A node with no negotiated Format (suspended)
+# prints nothing and its request closes at the shared deadline. Only a pw-cli
+# that never prints the headers gets its replies matched by the order sent.
+
+import json
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from metrics import spawn
+
+_HEADER = re.compile(r'remote \d+ \w+ (\d+) param \d+ index \d+')
+_PROP_KEY = re.compile(r'Prop: key \S+:(\w+) ')
+_INT_VALUE = re.compile(r'Int\s+(\d+)')
+_ENUM_FORMAT = re.compile(r'AudioFormat:([a-zA-Z0-9_]+)')
+_SIMPLE_FORMAT = re.compile(r'\((F32LE|S16LE|S24LE|S32LE|S24_32LE)\)')
+
+
+class _Request:
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.rate = None
+        self.fmt = "Unknown"
+        self.key = None # Pod property we are inside of
+        self.done = threading.Event()
+
+    def feed(self, line):
+        # Walks the spa_debug_pod() dump one line at a time
+        m = _PROP_KEY.search(line)
+        if m:
+            self.key = m.group(1)
+            return
+        if self.key == 'rate' and self.rate is None:
+            m = _INT_VALUE.search(line)
+            if m: self.rate = m.group(1)
+        elif self.key == 'format' and self.fmt == "Unknown":
+            m = _ENUM_FORMAT.search(line) or _SIMPLE_FORMAT.search(line)
+            if m: self.fmt = m.group(1)
+        if self.rate and self.fmt != "Unknown":
+            self.done.set()
+
+
+class PwCliSession:
+    MAX_TIMEOUTS = 3 # Consecutive misses before the session counts as hung
+
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.process = None
+        self.pending = {}   # node_id -> _Request waiting for a reply
+        self.order = []     # Same requests in the order they were sent
+        self.current = None # Request whose pod is being printed right now
+        self.tagged = False # Seen a "remote N object ID param" header yet
+        self.timeouts = 0
+
+    def start(self):
+        cmd = ["pw-cli"]
+        # pw-cli writes through stdio, keep it line-buffered on a pipe
+        if shutil.which("stdbuf"):
+            cmd = ["stdbuf", "-oL"] + cmd
+        with spawn("pw-cli"):
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        threading.Thread(target=self._read_loop, args=(self.process,), daemon=True).start()
+
+    def close(self):
+        with self.lock:
+            proc, self.process = self.process, None
+            self._fail_pending()
+        if proc and proc.poll() is None:
+            try:
+                proc.stdin.write("quit\n")
+                proc.stdin.flush()
+                proc.wait(timeout=1)
+            except Exception:
+                proc.kill()
+
+    def send(self, command):
+        # Fire-and-forget command on the same session (set-param etc.)
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self._fail_pending()
+                self.start()
+            self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+
+    def enum_formats(self, node_ids, timeout=None):
+        # Asks for the Format of several nodes at once and waits for all of
+        # them with one shared deadline. Returns {node_id: (rate, fmt)}.
+        deadline = time.monotonic() + (timeout or self.timeout)
+        requests = []
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self._fail_pending()
+                self.start()
+            for node_id in node_ids:
+                req = self.pending.get(node_id)
+                if req is None:
+                    req = _Request(node_id)
+                    self.pending[node_id] = req
+                    self.order.append(req)
+                    self.process.stdin.write(f"enum-params {node_id} Format\n")
+                requests.append(req)
+            self.process.stdin.flush()
+
+        for req in requests:
+            req.done.wait(max(0, deadline - time.monotonic()))
+
+        results = {}
+        with self.lock:
+            missed = 0
+            for req in requests:
+                if not req.done.is_set():
+                    missed += 1
+                    self._forget(req)
+                results[req.node_id] = (req.rate, req.fmt)
+            # A node without a negotiated Format never answers, so only a run
+            # of misses with nothing coming back means pw-cli itself is stuck
+            self.timeouts = self.timeouts + 1 if missed == len(requests) else 0
+            if self.timeouts >= self.MAX_TIMEOUTS:
+                print("[pw-cli] Session not responding, restarting")
+                self.timeouts = 0
+                proc, self.process = self.process, None
+                self._fail_pending()
+                if proc: proc.kill()
+        return results
+
+    def _read_loop(self, proc):
+        for line in proc.stdout:
+            with self.lock:
+                m = _HEADER.search(line)
+                if m:
+                    self._finish_current()
+                    self.tagged = True
+                    self.current = self.pending.get(int(m.group(1)))
+                elif line[:1].isspace():
+                    if self.current is None and not self.tagged and self.order:
+                        # No header (older pw-cli): replies come back in order
+                        self.current = self.order[0]
+                    if self.current is not None:
+                        self.current.feed(line)
+                else:
+                    self._finish_current()
+        with self.lock:
+            if self.process is proc:
+                self.process = None
+                self._fail_pending()
+
+    def _finish_current(self):
+        if self.current is not None:
+            self.current.done.set()
+            self._forget(self.current)
+            self.current = None
+
+    def _forget(self, req):
+        if self.pending.get(req.node_id) is req:
+            del self.pending[req.node_id]
+        if req in self.order:
+            self.order.remove(req)
+
+    def _fail_pending(self):
+        for req in self.order:
+            req.done.set()
+        self.pending.clear()
+        self.order = []
+        self.current = None
+
+
+def format_from_params(info):
+    # pw-dump already lists the negotiated Format for nodes it can read
+    for param in (info.get('params') or {}).get('Format') or ():
+        if isinstance(param, dict):
+            rate = param.get('rate')
+            fmt = param.get('format')
+            if isinstance(rate, int) and rate > 0:
+                return str(rate), fmt if isinstance(fmt, str) else "Unknown"
+    return None
+
+
+class FormatCache:
+    # node_id -> (object.serial, Format params as pw-dump shows them, rate, fmt)
+    # Node ids get reused by PipeWire, serials don't. A changed Format param
+    # means the stream renegotiated, so the entry is dropped and re-probed.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, node):
+        info = node.get('info') or {}
+        serial = (info.get('props') or {}).get('object.serial')
+        params = json.dumps((info.get('params') or {}).get('Format'), sort_keys=True)
+        return serial, params
+
+    def get(self, node):
+        with self.lock:
+            entry = self.entries.get(node.get('id'))
+            if entry and entry[:2] == self._key(node):
+                self.hits += 1
+                return entry[2], entry[3]
+            self.misses += 1
+            return None
+
+    def put(self, node, rate, fmt):
+        with self.lock:
+            self.entries[node.get('id')] = self._key(node) + (rate, fmt)
+
+    def evict(self, node_id):
+        with self.lock:
+            self.entries.pop(node_id, None)
@@ -0,0 +1,181 @@
+# ==============================================================================
+# === STREAMING PW-DUMP PARSER ===
+# ==============================================================================
+# pw-dump prints the whole graph as one JSON array, which gets to several MB on
+# busy machines. We only ever look at a handful of nodes, so instead of
+# json.loads() on everything this reads the pipe in chunks, cuts out one
+# top-level object at a time and only decodes the ones that can match.
+# Works for a plain dump as well as `pw-dump --monitor`, which prints one
+# array per update.
+
+import codecs
+import json
+import os
+import re
+import subprocess
+
+from metrics import spawn
+
+NODE_TYPE = "PipeWire:Interface:Node"
+LINK_TYPE = "PipeWire:Interface:Link"
+
+_STRUCTURAL = re.compile(r'[\[\]{}"]')
+_STRING_TAIL = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+_NEXT_TOKEN = re.compile(r'[^\s,]')
+_ELEMENT_END = "\n  }"
+
+
+def _read(stream, size):
+    try:
+        # Hand back whatever is in the pipe right now, monitor output is slow
+        return os.read(stream.fileno(), size)
+    except (AttributeError, OSError, ValueError):
+        data = stream.read(size)
+        return data.encode() if isinstance(data, str) else data
+
+
+def scan(stream, chunk_size=65536, stats=None):
+    # Yields the raw text of each top-level array element, plus None whenever a
+    # top-level array closes (the end of one monitor update).
+    #
+    # pw-dump pretty-prints with two spaces per level, so a top-level object
+    # always closes on a line that is exactly "  }" or "  },". That lets us
+    # jump over whole objects with str.find(). Anything not laid out like that
+    # goes through the slower token-by-token scanner instead.
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buf = ""
+    pos = 0
+    depth = 0
+    start = -1
+    pretty = None # Decided on the first element
+
+    while True:
+        chunk = _read(stream, chunk_size)
+        if not chunk:
+            break
+        if stats is not None:
+            stats['bytes'] = stats.get('bytes', 0) + len(chunk)
+        buf += decoder.decode(chunk)
+
+        while True:
+            if pretty and start >= 0:
+                j = buf.find(_ELEMENT_END, pos)
+                if j < 0 or j + 4 >= len(buf):
+                    pos = max(pos, len(buf) - 4)
+                    break
+                pos = j + 4
+                if buf[pos] in ',\n':
+                    yield buf[start:pos]
+                    start = -1
+                    depth = 1
+                continue
+
+            if depth <= 1:
+                m = _NEXT_TOKEN.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                i = m.start()
+                if buf[i] == '{' and depth == 1 and pretty is None:
+                    pretty = buf.endswith("\n  ", 0, i)
+                if pretty and buf[i] == '{' and depth == 1:
+                    start = i
+                    pos = i + 1
+                    depth = 2
+                    continue
+
+            m = _STRUCTURAL.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            i = m.start()
+            ch = buf[i]
+            if ch == '"':
+                tail = _STRING_TAIL.match(buf, i + 1)
+                if tail is None:
+                    pos = i # The string goes on in the next chunk
+                    break
+                pos = tail.end()
+                continue
+
+            pos = i + 1
+            if ch == '[' or ch == '{':
+                depth += 1
+                if depth == 2:
+                    start = i
+            else:
+                depth -= 1
+                if depth == 1 and start >= 0:
+                    yield buf[start:pos]
+                    start = -1
+                elif depth == 0:
+                    yield None
+
+        # Drop everything we are done with, keep a half-read element
+        keep = start if start >= 0 else pos
+        if keep:
+            buf = buf[keep:]
+            pos -= keep
+            if start >= 0:
+                start = 0
+
+
+def iter_objects(stream, types=None, states=None, media_classes=None,
+                 removals=False, batches=False, stats=None):
+    # types: exact "type" values to keep.
+    # states: node states to keep ("running", ...).
+    # media_classes: substrings of media.class to keep ("Stream/Output/Audio").
+    # removals: also yield {"id": N, "info": null} entries from --monitor.
+    # batches: yield None after each top-level array.
+    type_keys = [f'"{t}"' for t in types] if types else None
+    state_keys = [f'"{s}"' for s in states] if states else None
+    class_keys = list(media_classes) if media_classes else None
+
+    for raw in scan(stream, stats=stats):
+        if raw is None:
+            if batches:
+                yield None
+            continue
+
+        # Cheap substring checks first, only decode what can possibly match
+        if removals and len(raw) < 128 and 'null' in raw:
+            obj = json.loads(raw)
+            if obj.get('info', {}) is None:
+                yield obj
+                continue
+        if type_keys and not any(k in raw for k in type_keys):
+            continue
+        if state_keys and not any(k in raw for k in state_keys):
+            continue
+        if class_keys and not any(k in raw for k in class_keys):
+            continue
+
+        obj = json.loads(raw)
+        if types and obj.get('type') not in types:
+            continue
+        if states or class_keys:
+            info = obj.get('info') or {}
+            if states and (info.get('state') or '').lower() not in states:
+                continue
+            if class_keys:
+                media_class = (info.get('props') or {}).get('media.class', '')
+                if not any(k in media_class for k in class_keys):
+                    continue
+        yield obj
+
+
+def iter_nodes(stream, states=None, media_classes=None, stats=None):
+    return iter_objects(stream, types=(NODE_TYPE,), states=states,
+                        media_classes=media_classes, stats=stats)
+
+
+def dump_nodes(states=None, media_classes=None, stats=None):
+    # One-shot `pw-dump`, yielding only the matching nodes
+    with spawn("pw-dump"):
+        proc = subprocess.Popen(['pw-dump'], stdout=subprocess.PIPE)
+    try:
+        yield from iter_nodes(proc.stdout, states=states,
+                              media_classes=media_classes, stats=stats)
+    finally:
+        proc.stdout.close()
+        proc.wait()
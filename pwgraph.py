@@ -0,0 +1,206 @@
+# ==============================================================================
+# === PIPEWIRE GRAPH WATCHER ===
+# ==============================================================================
+# Keeps an in-memory copy of the PipeWire node graph. A single long-lived
+# `pw-dump --monitor` process streams the initial graph followed by every
+# change, so nothing has to be re-dumped while the graph sits still.
+
+import subprocess
+import threading
+import time
+
+from pwdump import NODE_TYPE, LINK_TYPE, iter_objects
+from metrics import spawn, EXCEPTIONS
+
+
+class NodeTable:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = {}     # id -> pw-dump object
+        self.by_state = {}  # "running" -> {ids}
+        self.by_class = {}  # "Stream/Output/Audio" -> {ids}
+        self.links = {}     # link id -> (output node id, input node id)
+        self.outputs = {}   # node id -> {link ids leaving it}
+
+    def clear(self):
+        with self.lock:
+            self.nodes.clear()
+            self.by_state.clear()
+            self.by_class.clear()
+            self.links.clear()
+            self.outputs.clear()
+
+    def apply(self, obj):
+        # Returns "added", "changed", "removed" or None (not a node or link / unknown id)
+        node_id = obj.get('id')
+        if node_id is None:
+            return None
+
+        with self.lock:
+            if obj.get('type') == LINK_TYPE or node_id in self.links:
+                return self._apply_link(node_id, obj)
+
+            old = self.nodes.get(node_id)
+
+            # Removals come through as {"id": N, "info": null}
+            if obj.get('info', {}) is None:
+                if old is None:
+                    return None
+                self._unindex(node_id, old)
+                del self.nodes[node_id]
+                return "removed"
+
+            if old is None:
+                if obj.get('type') != NODE_TYPE:
+                    return None
+                self.nodes[node_id] = obj
+                self._index(node_id, obj)
+                return "added"
+
+            # Updates only carry what changed, merge them into what we have
+            self._unindex(node_id, old)
+            info = dict(old.get('info') or {})
+            info.update(obj.get('info') or {})
+            merged = dict(old)
+            merged.update(obj)
+            merged['info'] = info
+            self.nodes[node_id] = merged
+            self._index(node_id, merged)
+            return "changed"
+
+    def select(self, state=None, media_class=None):
+        # media_class matches as a substring, like the old "in media_class" test
+        with self.lock:
+            ids = None
+            if state is not None:
+                ids = set(self.by_state.get(state, ()))
+            if media_class is not None:
+                class_ids = set()
+                for name, members in self.by_class.items():
+                    if media_class in name:
+                        class_ids |= members
+                ids = class_ids if ids is None else ids & class_ids
+            if ids is None:
+                ids = self.nodes.keys()
+            return [self.nodes[i] for i in sorted(ids)]
+
+    def get(self, node_id):
+        with self.lock:
+            return self.nodes.get(node_id)
+
+    def resolve_driver(self, node_id, max_hops=8):
+        # Follows links downstream from a stream to the hardware sink that
+        # drives it. Virtual sinks and filter chains (EasyEffects, loopbacks)
+        # are walked through. Falls back to the last Audio/Sink passed on the
+        # way, None when the stream isn't linked anywhere yet.
+        with self.lock:
+            seen = {node_id}
+            frontier = [node_id]
+            fallback = None
+            for _ in range(max_hops):
+                following = []
+                for current in frontier:
+                    for link_id in sorted(self.outputs.get(current, ())):
+                        target = self.links[link_id][1]
+                        if target in seen:
+                            continue
+                        seen.add(target)
+                        node = self.nodes.get(target)
+                        props = ((node or {}).get('info') or {}).get('props') or {}
+                        if props.get('media.class', '').startswith('Audio/Sink'):
+                            if props.get('api.alsa.path') or props.get('device.api') or props.get('api.bluez5.address'):
+                                return target
+                            if fallback is None:
+                                fallback = target
+                        following.append(target)
+                if not following:
+                    break
+                frontier = following
+            return fallback
+
+    def _apply_link(self, link_id, obj):
+        old = self.links.pop(link_id, None)
+        if old is not None:
+            members = self.outputs.get(old[0])
+            if members is not None:
+                members.discard(link_id)
+                if not members:
+                    del self.outputs[old[0]]
+        info = obj.get('info', {})
+        if info is None:
+            return "removed" if old is not None else None
+        out_node = info.get('output-node-id', old[0] if old else None)
+        in_node = info.get('input-node-id', old[1] if old else None)
+        if out_node is None or in_node is None:
+            return None
+        self.links[link_id] = (out_node, in_node)
+        self.outputs.setdefault(out_node, set()).add(link_id)
+        return "changed" if old is not None else "added"
+
+    def _keys(self, obj):
+        info = obj.get('info') or {}
+        state = (info.get('state') or '').lower()
+        media_class = (info.get('props') or {}).get('media.class', '')
+        return state, media_class
+
+    def _index(self, node_id, obj):
+        state, media_class = self._keys(obj)
+        self.by_state.setdefault(state, set()).add(node_id)
+        self.by_class.setdefault(media_class, set()).add(node_id)
+
+    def _unindex(self, node_id, obj):
+        state, media_class = self._keys(obj)
+        for index, key in ((self.by_state, state), (self.by_class, media_class)):
+            members = index.get(key)
+            if members is not None:
+                members.discard(node_id)
+                if not members:
+                    del index[key]
+
+
+class GraphWatcher(threading.Thread):
+    def __init__(self, table, on_change=None):
+        super().__init__(daemon=True)
+        self.table = table
+        self.on_change = on_change
+        self.running = True
+        self.process = None
+        self.stats = {} # {"bytes": total read from pw-dump}
+
+    def stop(self):
+        self.running = False
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def run(self):
+        while self.running:
+            try:
+                with spawn("pw-dump"):
+                    self.process = subprocess.Popen(['pw-dump', '--monitor'],
+                                                    stdout=subprocess.PIPE)
+                # A fresh monitor starts with a full snapshot
+                self.table.clear()
+                batch = []
+                # Ports, clients, devices etc. are skipped without being decoded
+                for obj in iter_objects(self.process.stdout, types=(NODE_TYPE, LINK_TYPE),
+                                        removals=True, batches=True, stats=self.stats):
+                    if obj is not None:
+                        batch.append(obj)
+                        continue
+                    self.handle_batch(batch)
+                    batch = []
+                self.process.wait()
+            except Exception as e:
+                EXCEPTIONS.inc(where="graph")
+                print(f"[Graph] {e}")
+            if self.running:
+                time.sleep(2)
+
+    def handle_batch(self, objects):
+        changes = []
+        for obj in objects:
+            kind = self.table.apply(obj)
+            if kind:
+                changes.append((kind, obj.get('id')))
+        if changes and self.on_change:
+            self.on_change(changes)
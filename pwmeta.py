@@ -0,0 +1,97 @@
+# ==============================================================================
+# === CLOCK METADATA WRITER ===
+# ==============================================================================
+# Mirrors the `settings` metadata through one long-lived `pw-metadata -m` and
+# only writes clock.force-rate / clock.force-quantum when they would actually
+# change. Every write makes PipeWire reconfigure the graph (and some DACs
+# re-lock), so writing the value that is already there is never free.
+#
+# A key only counts as holding a value once the monitor reported it or a
+# write of it succeeded. Until then it is written even if it looks like the
+# "0" default, so a force left over from an earlier session gets cleared.
+
+import re
+import subprocess
+import threading
+import time
+
+from metrics import spawn, EXCEPTIONS
+
+_UPDATE = re.compile(r"update: id:(\d+) key:'([^']*)' value:'([^']*)'")
+
+
+class MetadataWriter:
+    def __init__(self, name="settings", on_change=None):
+        self.name = name
+        self.on_change = on_change # on_change(key, value) per update the monitor reports
+        self.lock = threading.Lock()
+        self.values = {} # key -> value on subject 0, as the monitor reports them
+        self.running = True
+        self.process = None
+        self.writes = 0
+        self.skipped = 0
+
+    def start(self):
+        threading.Thread(target=self._monitor_loop, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def get(self, key):
+        with self.lock:
+            return self.values.get(key, "0")
+
+    def apply(self, settings, force=False):
+        # settings: {"clock.force-rate": 44100, "clock.force-quantum": 0}.
+        # Keys already holding the value are dropped, the rest go out together.
+        # Returns what was written, a failed write is left for the next call.
+        with self.lock:
+            changes = [(key, str(value)) for key, value in settings.items()
+                       if force or self.values.get(key) != str(value)]
+            self.skipped += len(settings) - len(changes)
+        written = []
+        for key, value in changes:
+            self.writes += 1
+            try:
+                with spawn("pw-metadata"):
+                    result = subprocess.run(["pw-metadata", "-n", self.name, "0", key, value],
+                                            stdout=subprocess.DEVNULL, timeout=5)
+            except (subprocess.TimeoutExpired, OSError) as e:
+                EXCEPTIONS.inc(where="metadata")
+                print(f"[Metadata] {key}={value} not written: {e}")
+                continue
+            if result.returncode != 0:
+                EXCEPTIONS.inc(where="metadata")
+                print(f"[Metadata] {key}={value} not written: pw-metadata exited with {result.returncode}")
+                continue
+            with self.lock:
+                self.values[key] = value
+            written.append((key, value))
+        return written
+
+    def _monitor_loop(self):
+        while self.running:
+            try:
+                with spawn("pw-metadata"):
+                    self.process = subprocess.Popen(["pw-metadata", "-m", "-n", self.name],
+                                                    stdout=subprocess.PIPE, text=True)
+                for line in self.process.stdout:
+                    m = _UPDATE.search(line)
+                    if not m or m.group(1) != "0":
+                        continue
+                    key, value = m.group(2), m.group(3)
+                    with self.lock:
+                        if value in ("", "(null)"):
+                            self.values.pop(key, None)
+                            value = None
+                        else:
+                            self.values[key] = value
+                    if self.on_change:
+                        self.on_change(key, value)
+                self.process.wait()
+            except Exception as e:
+                print(f"[Metadata] {e}")
+            if self.running:
+                time.sleep(2)
@@ -0,0 +1,468 @@
+# ==============================================================================
+# === NATIVE LIBPIPEWIRE BACKEND (ctypes) ===
+# ==============================================================================
+# Talks to the PipeWire daemon through libpipewire-0.3 instead of pw-dump /
+# pw-cli / pw-metadata. Registry and node events arrive on a pw_thread_loop and
+# are turned into the same pw-dump shaped objects the rest of the app uses, so
+# the node table, format cache and monitor loop don't care which backend runs.
+#
+# Most of the PipeWire API is static inline functions calling through a method
+# table (spa_interface), so those are called by reading the table ourselves.
+
+import ctypes
+import ctypes.util
+import struct
+import threading
+
+from backend import Backend
+from pwdump import NODE_TYPE, LINK_TYPE
+
+from ctypes import (CFUNCTYPE, POINTER, Structure, c_char_p, c_int, c_size_t,
+                    c_uint32, c_uint64, c_void_p)
+
+PW_VERSION_REGISTRY = 3
+PW_VERSION_NODE = 3
+PW_VERSION_METADATA = 3
+
+PW_NODE_CHANGE_MASK_STATE = 1 << 2
+PW_NODE_CHANGE_MASK_PROPS = 1 << 3
+
+SPA_PARAM_Props = 2
+SPA_PARAM_EnumFormat = 3
+SPA_PARAM_Format = 4
+SPA_TYPE_Id = 3
+SPA_TYPE_Int = 4
+SPA_TYPE_String = 8
+SPA_TYPE_Struct = 14
+SPA_TYPE_Object = 15
+SPA_TYPE_Choice = 19
+SPA_TYPE_OBJECT_Props = 0x40002
+SPA_PROP_params = 0x80001
+SPA_FORMAT_AUDIO_format = 0x10001
+SPA_FORMAT_AUDIO_rate = 0x10003
+SPA_CHOICE_Range = 1
+SPA_CHOICE_Step = 2
+SPA_CHOICE_Enum = 3
+
+METADATA_TYPE = "PipeWire:Interface:Metadata"
+
+# Proxies keep the type string pointer they were bound with, keep ours alive
+_TYPE_NAMES = {NODE_TYPE: NODE_TYPE.encode(), METADATA_TYPE: METADATA_TYPE.encode()}
+
+NODE_STATES = {-1: "error", 0: "creating", 1: "suspended", 2: "idle", 3: "running"}
+
+# enum spa_audio_format, named the way pw-cli prints them
+AUDIO_FORMATS = dict(enumerate((
+    "S8", "U8", "S16LE", "S16BE", "U16LE", "U16BE", "S24_32LE", "S24_32BE",
+    "U24_32LE", "U24_32BE", "S32LE", "S32BE", "U32LE", "U32BE", "S24LE", "S24BE",
+    "U24LE", "U24BE", "S20LE", "S20BE", "U20LE", "U20BE", "S18LE", "S18BE",
+    "U18LE", "U18BE", "F32LE", "F32BE", "F64LE", "F64BE", "ULAW", "ALAW",
+), start=0x101))
+AUDIO_FORMATS.update(enumerate((
+    "U8P", "S16P", "S24_32P", "S32P", "S24P", "F32P", "F64P", "S8P",
+), start=0x201))
+
+
+class SpaDictItem(Structure):
+    _fields_ = [("key", c_char_p), ("value", c_char_p)]
+
+
+class SpaDict(Structure):
+    _fields_ = [("flags", c_uint32), ("n_items", c_uint32), ("items", POINTER(SpaDictItem))]
+
+
+class SpaCallbacks(Structure):
+    _fields_ = [("funcs", c_void_p), ("data", c_void_p)]
+
+
+class SpaInterface(Structure):
+    _fields_ = [("type", c_char_p), ("version", c_uint32), ("cb", SpaCallbacks)]
+
+
+class SpaHook(Structure):
+    _fields_ = [("prev", c_void_p), ("next", c_void_p), ("cb", SpaCallbacks),
+                ("removed", c_void_p), ("priv", c_void_p)]
+
+
+class NodeInfo(Structure):
+    _fields_ = [("id", c_uint32), ("max_input_ports", c_uint32), ("max_output_ports", c_uint32),
+                ("change_mask", c_uint64), ("n_input_ports", c_uint32), ("n_output_ports", c_uint32),
+                ("state", c_int), ("error", c_char_p), ("props", POINTER(SpaDict)),
+                ("params", c_void_p), ("n_params", c_uint32)]
+
+
+ADD_LISTENER = CFUNCTYPE(c_int, c_void_p, POINTER(SpaHook), c_void_p, c_void_p)
+
+
+class CoreMethods(Structure):
+    _fields_ = [("version", c_uint32), ("add_listener", ADD_LISTENER), ("hello", c_void_p),
+                ("sync", c_void_p), ("pong", c_void_p), ("error", c_void_p),
+                ("get_registry", CFUNCTYPE(c_void_p, c_void_p, c_uint32, c_size_t)),
+                ("create_object", c_void_p), ("destroy", c_void_p)]
+
+
+class RegistryMethods(Structure):
+    _fields_ = [("version", c_uint32), ("add_listener", ADD_LISTENER),
+                ("bind", CFUNCTYPE(c_void_p, c_void_p, c_uint32, c_char_p, c_uint32, c_size_t)),
+                ("destroy", c_void_p)]
+
+
+class NodeMethods(Structure):
+    _fields_ = [("version", c_uint32), ("add_listener", ADD_LISTENER),
+                ("subscribe_params", CFUNCTYPE(c_int, c_void_p, POINTER(c_uint32), c_uint32)),
+                ("enum_params", c_void_p),
+                ("set_param", CFUNCTYPE(c_int, c_void_p, c_uint32, c_uint32, c_void_p)),
+                ("send_command", c_void_p)]
+
+
+class MetadataMethods(Structure):
+    _fields_ = [("version", c_uint32), ("add_listener", ADD_LISTENER),
+                ("set_property", CFUNCTYPE(c_int, c_void_p, c_uint32, c_char_p, c_char_p, c_char_p)),
+                ("clear", c_void_p)]
+
+
+GLOBAL_EVENT = CFUNCTYPE(None, c_void_p, c_uint32, c_uint32, c_char_p, c_uint32, POINTER(SpaDict))
+GLOBAL_REMOVE_EVENT = CFUNCTYPE(None, c_void_p, c_uint32)
+NODE_INFO_EVENT = CFUNCTYPE(None, c_void_p, POINTER(NodeInfo))
+NODE_PARAM_EVENT = CFUNCTYPE(None, c_void_p, c_int, c_uint32, c_uint32, c_uint32, c_void_p)
+PROPERTY_EVENT = CFUNCTYPE(c_int, c_void_p, c_uint32, c_char_p, c_char_p, c_char_p)
+
+
+class RegistryEvents(Structure):
+    _fields_ = [("version", c_uint32), ("global_", GLOBAL_EVENT), ("global_remove", GLOBAL_REMOVE_EVENT)]
+
+
+class NodeEvents(Structure):
+    _fields_ = [("version", c_uint32), ("info", NODE_INFO_EVENT), ("param", NODE_PARAM_EVENT)]
+
+
+class MetadataEvents(Structure):
+    _fields_ = [("version", c_uint32), ("property", PROPERTY_EVENT)]
+
+
+def load_library():
+    name = ctypes.util.find_library("pipewire-0.3") or "libpipewire-0.3.so.0"
+    lib = ctypes.CDLL(name)
+    lib.pw_init.argtypes = [c_void_p, c_void_p]
+    lib.pw_thread_loop_new.argtypes = [c_char_p, c_void_p]
+    lib.pw_thread_loop_new.restype = c_void_p
+    lib.pw_thread_loop_get_loop.argtypes = [c_void_p]
+    lib.pw_thread_loop_get_loop.restype = c_void_p
+    for fn in ("pw_thread_loop_start", "pw_thread_loop_lock", "pw_thread_loop_unlock",
+               "pw_thread_loop_stop", "pw_thread_loop_destroy", "pw_context_destroy",
+               "pw_core_disconnect", "pw_proxy_destroy"):
+        getattr(lib, fn).argtypes = [c_void_p]
+    lib.pw_context_new.argtypes = [c_void_p, c_void_p, c_size_t]
+    lib.pw_context_new.restype = c_void_p
+    lib.pw_context_connect.argtypes = [c_void_p, c_void_p, c_size_t]
+    lib.pw_context_connect.restype = c_void_p
+    lib.pw_init(None, None)
+    return lib
+
+
+def _methods(proxy, methods_type):
+    # Resolve a proxy's spa_interface into (method table, first argument)
+    iface = SpaInterface.from_address(proxy)
+    return methods_type.from_address(iface.cb.funcs), iface.cb.data
+
+
+def _dict(spa_dict):
+    props = {}
+    if spa_dict:
+        d = spa_dict.contents
+        for i in range(d.n_items):
+            item = d.items[i]
+            if item.key is not None:
+                props[item.key.decode(errors='replace')] = \
+                    item.value.decode(errors='replace') if item.value is not None else None
+    return props
+
+
+def parse_format_pod(address):
+    # Pulls (rate, format) out of a Format param pod. Returns (None, "Unknown")
+    # if it isn't an audio format object.
+    size, pod_type = struct.unpack_from("=II", ctypes.string_at(address, 8))
+    rate, fmt = None, "Unknown"
+    if pod_type != SPA_TYPE_Object:
+        return rate, fmt
+    body = ctypes.string_at(address + 8, size)
+    offset = 8 # Skip object type and id
+    while offset + 16 <= len(body):
+        key, _flags, value_size, value_type = struct.unpack_from("=IIII", body, offset)
+        value = body[offset + 16:offset + 16 + value_size]
+        if value_type == SPA_TYPE_Choice and len(value) >= 16:
+            # Choice body: choice type, flags, child pod header, then values.
+            # The first value is the default, which is all we need.
+            child_size, value_type = struct.unpack_from("=II", value, 8)
+            value = value[16:16 + child_size]
+        if len(value) >= 4 and value_type in (SPA_TYPE_Id, SPA_TYPE_Int):
+            number = struct.unpack_from("=i" if value_type == SPA_TYPE_Int else "=I", value)[0]
+            if key == SPA_FORMAT_AUDIO_rate and number > 0:
+                rate = str(number)
+            elif key == SPA_FORMAT_AUDIO_format:
+                fmt = AUDIO_FORMATS.get(number, "Unknown")
+        offset += 16 + ((value_size + 7) & ~7)
+    return rate, fmt
+
+
+def parse_enum_format_pod(address):
+    # One EnumFormat entry in pw-dump's shape: {"format": ..., "rate": ...}
+    # with choices as {"default", "alternatives"} or {"default", "min", "max"}
+    size, pod_type = struct.unpack_from("=II", ctypes.string_at(address, 8))
+    entry = {}
+    if pod_type != SPA_TYPE_Object:
+        return entry
+    body = ctypes.string_at(address + 8, size)
+    offset = 8
+    while offset + 16 <= len(body):
+        key, _flags, value_size, value_type = struct.unpack_from("=IIII", body, offset)
+        value = body[offset + 16:offset + 16 + value_size]
+        offset += 16 + ((value_size + 7) & ~7)
+        if key not in (SPA_FORMAT_AUDIO_rate, SPA_FORMAT_AUDIO_format):
+            continue
+        choice = None
+        if value_type == SPA_TYPE_Choice and len(value) >= 16:
+            choice, _cflags, child_size, value_type = struct.unpack_from("=IIII", value)
+            values = [value[i:i + child_size] for i in range(16, len(value) - child_size + 1, child_size or 4)]
+        else:
+            values = [value]
+        if value_type not in (SPA_TYPE_Id, SPA_TYPE_Int):
+            continue
+        numbers = [struct.unpack_from("=i" if value_type == SPA_TYPE_Int else "=I", v)[0]
+                   for v in values if len(v) >= 4]
+        if key == SPA_FORMAT_AUDIO_format:
+            numbers = [AUDIO_FORMATS.get(n, "Unknown") for n in numbers]
+        if not numbers:
+            continue
+        if choice in (SPA_CHOICE_Range, SPA_CHOICE_Step) and len(numbers) >= 3:
+            parsed = {"default": numbers[0], "min": numbers[1], "max": numbers[2]}
+        elif choice == SPA_CHOICE_Enum:
+            parsed = {"default": numbers[0], "alternatives": numbers[1:]}
+        else:
+            parsed = numbers[0]
+        entry["rate" if key == SPA_FORMAT_AUDIO_rate else "format"] = parsed
+    return entry
+
+
+def _pod(pod_type, body):
+    return struct.pack("=II", len(body), pod_type) + body + b"\0" * (-len(body) % 8)
+
+
+def build_params_pod(params):
+    # Props object carrying a "params" struct of key/value pairs, the binary
+    # form of pw-cli's '{ params = [ "key" value ... ] }'
+    fields = b""
+    for key, value in params.items():
+        fields += _pod(SPA_TYPE_String, key.encode() + b"\0")
+        fields += _pod(SPA_TYPE_Int, struct.pack("=i", int(value)))
+    prop = struct.pack("=II", SPA_PROP_params, 0) + _pod(SPA_TYPE_Struct, fields)
+    return _pod(SPA_TYPE_Object, struct.pack("=II", SPA_TYPE_OBJECT_Props, SPA_PARAM_Props) + prop)
+
+
+class NativeBackend(Backend):
+    name = "native"
+
+    def __init__(self):
+        super().__init__()
+        self.lib = load_library()
+        self.lock = threading.Lock() # Guards self.settings
+        self.settings = {}  # Mirror of the settings metadata, subject 0
+        self.proxies = {}   # global id -> (proxy, hook, events) kept alive for C
+        self.thread_loop = None
+        self.context = None
+        self.core = None
+        self.registry = None
+        self.metadata = None
+        self.writes = 0
+        self.skipped = 0
+
+        self._registry_events = RegistryEvents(0, GLOBAL_EVENT(self._on_global),
+                                               GLOBAL_REMOVE_EVENT(self._on_global_remove))
+        self._node_events = NodeEvents(0, NODE_INFO_EVENT(self._on_node_info),
+                                       NODE_PARAM_EVENT(self._on_node_param))
+        self._metadata_events = MetadataEvents(0, PROPERTY_EVENT(self._on_property))
+        self._registry_hook = SpaHook()
+
+    def start(self, on_change):
+        super().start(on_change)
+        lib = self.lib
+        self.thread_loop = lib.pw_thread_loop_new(b"pw-rate-switcher", None)
+        self.context = lib.pw_context_new(lib.pw_thread_loop_get_loop(self.thread_loop), None, 0)
+        if not self.context:
+            raise RuntimeError("pw_context_new failed")
+        lib.pw_thread_loop_start(self.thread_loop)
+
+        lib.pw_thread_loop_lock(self.thread_loop)
+        try:
+            self.core = lib.pw_context_connect(self.context, None, 0)
+            if not self.core:
+                raise RuntimeError("Cannot connect to PipeWire")
+            methods, data = _methods(self.core, CoreMethods)
+            self.registry = methods.get_registry(data, PW_VERSION_REGISTRY, 0)
+            methods, data = _methods(self.registry, RegistryMethods)
+            methods.add_listener(data, ctypes.byref(self._registry_hook),
+                                 ctypes.addressof(self._registry_events), None)
+        finally:
+            lib.pw_thread_loop_unlock(self.thread_loop)
+
+    def stop(self):
+        lib = self.lib
+        if not self.thread_loop:
+            return
+        lib.pw_thread_loop_lock(self.thread_loop)
+        for proxy, _hook, _events in self.proxies.values():
+            lib.pw_proxy_destroy(proxy)
+        self.proxies.clear()
+        self.metadata = None
+        if self.registry:
+            lib.pw_proxy_destroy(self.registry)
+            self.registry = None
+        if self.core:
+            lib.pw_core_disconnect(self.core)
+            self.core = None
+        lib.pw_thread_loop_unlock(self.thread_loop)
+        lib.pw_thread_loop_stop(self.thread_loop)
+        lib.pw_context_destroy(self.context)
+        lib.pw_thread_loop_destroy(self.thread_loop)
+        self.thread_loop = None
+
+    # --- Registry (loop thread) ---
+
+    def _bind(self, global_id, type_name, version, events_type, events):
+        methods, data = _methods(self.registry, RegistryMethods)
+        proxy = methods.bind(data, global_id, type_name, version, 0)
+        if not proxy:
+            return None
+        hook = SpaHook()
+        methods, data = _methods(proxy, events_type)
+        methods.add_listener(data, ctypes.byref(hook), ctypes.addressof(events), c_void_p(global_id))
+        self.proxies[global_id] = (proxy, hook, events)
+        return proxy
+
+    def _on_global(self, _data, global_id, _permissions, type_name, _version, props):
+        try:
+            kind = type_name.decode()
+            props = _dict(props)
+            if kind == NODE_TYPE and "Audio" in (props.get("media.class") or ""):
+                proxy = self._bind(global_id, _TYPE_NAMES[kind], PW_VERSION_NODE, NodeMethods, self._node_events)
+                if proxy:
+                    # Format params get pushed to us whenever they change,
+                    # sinks also send what they support (for caps.py)
+                    methods, data = _methods(proxy, NodeMethods)
+                    if props.get("media.class", "").startswith("Audio/Sink"):
+                        ids = (c_uint32 * 2)(SPA_PARAM_Format, SPA_PARAM_EnumFormat)
+                    else:
+                        ids = (c_uint32 * 1)(SPA_PARAM_Format)
+                    methods.subscribe_params(data, ids, len(ids))
+            elif kind == LINK_TYPE:
+                # Links carry their endpoints in the global props, no bind needed
+                self._push({"id": global_id, "type": LINK_TYPE, "info": {
+                    "output-node-id": int(props.get("link.output.node", -1)),
+                    "input-node-id": int(props.get("link.input.node", -1)),
+                    "props": props}})
+            elif kind == METADATA_TYPE and props.get("metadata.name") == "settings":
+                self.metadata = self._bind(global_id, _TYPE_NAMES[kind], PW_VERSION_METADATA,
+                                           MetadataMethods, self._metadata_events)
+        except Exception as e:
+            print(f"[native] {e}")
+
+    def _on_global_remove(self, _data, global_id):
+        entry = self.proxies.pop(global_id, None)
+        if entry is not None:
+            if entry[0] == self.metadata:
+                self.metadata = None
+            self.lib.pw_proxy_destroy(entry[0])
+        # Unknown ids (unbound nodes, clients...) are ignored by the table
+        self._push({"id": global_id, "info": None})
+
+    def _on_node_info(self, data, info_ptr):
+        try:
+            info = info_ptr.contents
+            update = {"state": NODE_STATES.get(info.state, "error")}
+            if info.change_mask & PW_NODE_CHANGE_MASK_PROPS:
+                update["props"] = _dict(info.props)
+            if info.error:
+                update["error"] = info.error.decode(errors='replace')
+            self._push({"id": data or 0, "type": NODE_TYPE, "info": update})
+        except Exception as e:
+            print(f"[native] {e}")
+
+    def _on_node_param(self, data, _seq, param_id, index, _next, param):
+        if param_id not in (SPA_PARAM_Format, SPA_PARAM_EnumFormat) or not param:
+            return
+        try:
+            node_id = data or 0
+            # Shaped like pw-dump's params so format_from_params() and
+            # caps_from_params() pick them up
+            if param_id == SPA_PARAM_Format:
+                rate, fmt = parse_format_pod(param)
+                name, entry = "Format", {"format": fmt}
+                if rate: entry["rate"] = int(rate)
+            else:
+                name, entry = "EnumFormat", parse_enum_format_pod(param)
+            # Updates replace info.params as a whole, keep the other param
+            node = self.graph.get(node_id) or {}
+            params = dict((node.get("info") or {}).get("params") or {})
+            entries = [] if name == "Format" or index == 0 else list(params.get(name) or [])
+            params[name] = entries + [entry]
+            self._push({"id": node_id, "type": NODE_TYPE, "info": {"params": params}})
+        except Exception as e:
+            print(f"[native] {e}")
+
+    def _on_property(self, _data, subject, key, _type, value):
+        if subject == 0 and key is not None:
+            with self.lock:
+                if value is None:
+                    self.settings.pop(key.decode(), None)
+                else:
+                    self.settings[key.decode()] = value.decode()
+        return 0
+
+    def _push(self, obj):
+        kind = self.graph.apply(obj)
+        if kind:
+            self.changed([(kind, obj.get('id'))])
+
+    # --- Clock metadata ---
+
+    def set_clock(self, settings, force=False):
+        with self.lock:
+            # Keys the metadata hasn't reported yet are written, see pwmeta.py
+            changes = [(key, str(value)) for key, value in settings.items()
+                       if force or self.settings.get(key) != str(value)]
+            self.skipped += len(settings) - len(changes)
+        if not changes:
+            return changes
+
+        # All keys go out in one loop iteration over the existing connection
+        self.lib.pw_thread_loop_lock(self.thread_loop)
+        try:
+            if not self.metadata:
+                raise RuntimeError("settings metadata not available")
+            methods, data = _methods(self.metadata, MetadataMethods)
+            for key, value in changes:
+                self.writes += 1
+                methods.set_property(data, 0, key.encode(), b"", value.encode())
+        finally:
+            self.lib.pw_thread_loop_unlock(self.thread_loop)
+        with self.lock:
+            for key, value in changes:
+                self.settings[key] = value
+        return changes
+
+    def get_setting(self, key):
+        with self.lock:
+            return self.settings.get(key, "0")
+
+    def write_driver_clock(self, driver_id, rate, quantum):
+        pod = ctypes.create_string_buffer(build_params_pod(
+            {"node.force-rate": rate, "node.force-quantum": quantum}))
+        self.lib.pw_thread_loop_lock(self.thread_loop)
+        try:
+            entry = self.proxies.get(driver_id)
+            if entry is None:
+                raise RuntimeError(f"driver {driver_id} is not bound")
+            methods, data = _methods(entry[0], NodeMethods)
+            methods.set_param(data, SPA_PARAM_Props, 0, ctypes.addressof(pod))
+        finally:
+            self.lib.pw_thread_loop_unlock(self.thread_loop)
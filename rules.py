@@ -0,0 +1,172 @@
+# ==============================================================================
+# === PER-APPLICATION RULES ===
+# ==============================================================================
+# Decides what a running stream is allowed to do with the clock, from
+# ~/.config/pw-rate-switcher/rules.json:
+#
+#   {"rules": [
+#     {"match": {"app": "Firefox", "role": "Notification"}, "action": "ignore"},
+#     {"match": {"binary": "spotify"}, "action": "prefer"},
+#     {"match": {"node.name": "~^mpd\\."}, "action": "pin", "rate": 96000},
+#     {"match": {"app": ["Strawberry", "Qobuz"]}, "action": "strict"}
+#   ]}
+#
+# Keys are node props (app, binary, role and node are short for
+# application.name, application.process.binary, media.role and node.name).
+# Values match case-insensitively. A list means any of them, "~" starts a
+# regular expression. The first rule whose keys all match wins:
+#   ignore  the stream never takes the clock (and is never probed)
+#   prefer  wins over streams without it, even ones that started earlier
+#   pin     the clock goes to "rate" instead of the stream's own rate
+#   strict  the stream's quantum is forced too, as in Strict Mode
+#
+# Notification and event sounds are ignored unless "defaults": false.
+#
+# Rules are compiled into one lookup table per prop key: every rule is a bit,
+# each key maps its exact values to the bits of the rules they satisfy, and a
+# node's rule is the lowest bit left after ANDing its keys together. The
+# result is cached per node until the node changes. The file is re-read when
+# its mtime changes.
+
+import json
+import os
+import re
+import time
+
+ACTIONS = ("ignore", "prefer", "pin", "strict")
+ALIASES = {
+    "app": "application.name",
+    "binary": "application.process.binary",
+    "role": "media.role",
+    "node": "node.name",
+    "class": "media.class",
+}
+DEFAULT_RULES = [
+    # Desktop sounds: a short beep must never re-lock the DAC
+    {"match": {"role": ["Notification", "Event", "Alert"]}, "action": "ignore"},
+]
+
+
+def rules_path():
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(base, "pw-rate-switcher", "rules.json")
+
+
+class RuleError(ValueError):
+    pass
+
+
+class Rule:
+    def __init__(self, index, spec):
+        self.index = index
+        self.action = spec.get("action")
+        if self.action not in ACTIONS:
+            raise RuleError(f"rule {index + 1}: action must be one of {', '.join(ACTIONS)}")
+        self.rate = spec.get("rate")
+        if self.action == "pin":
+            if not isinstance(self.rate, int) or self.rate <= 0:
+                raise RuleError(f"rule {index + 1}: pin needs a \"rate\" in Hz")
+        match = spec.get("match")
+        if not isinstance(match, dict) or not match:
+            raise RuleError(f"rule {index + 1}: \"match\" needs at least one key")
+        self.conditions = {} # prop key -> (exact values, regexes)
+        for key, values in match.items():
+            exact, patterns = set(), []
+            for value in values if isinstance(values, list) else [values]:
+                value = str(value)
+                if value.startswith("~"):
+                    try:
+                        patterns.append(re.compile(value[1:], re.IGNORECASE))
+                    except re.error as e:
+                        raise RuleError(f"rule {index + 1}: {e}")
+                else:
+                    exact.add(value.casefold())
+            self.conditions[ALIASES.get(key, key)] = (exact, patterns)
+        self.priority = 1 if self.action == "prefer" else 0
+
+    def __repr__(self):
+        return f"<Rule {self.index + 1} {self.action}>"
+
+
+class RuleSet:
+    def __init__(self, path=None):
+        self.path = path or rules_path()
+        self.mtime = None
+        self.checked_at = 0.0
+        self.cache = {} # node id -> Rule or None
+        self.compile(DEFAULT_RULES)
+        self.reload()
+
+    def compile(self, specs):
+        rules = [Rule(i, spec) for i, spec in enumerate(specs)]
+        everything = (1 << len(rules)) - 1
+        keys = {key for rule in rules for key in rule.conditions}
+        exact = {key: {} for key in keys}     # key -> {value: rule bits}
+        patterns = {key: [] for key in keys}  # key -> [(regex, rule bit)]
+        free = {key: everything for key in keys} # Rules that don't look at the key
+        for rule in rules:
+            bit = 1 << rule.index
+            for key, (values, regexes) in rule.conditions.items():
+                free[key] &= ~bit
+                for value in values:
+                    exact[key][value] = exact[key].get(value, 0) | bit
+                for regex in regexes:
+                    patterns[key].append((regex, bit))
+        self.rules, self.exact, self.patterns, self.free = rules, exact, patterns, free
+        self.cache = {}
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            if self.mtime is not None:
+                print("[Rules] Rules file gone, using the defaults")
+                self.mtime = None
+                self.compile(DEFAULT_RULES)
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            with open(self.path) as f:
+                config = json.load(f)
+            specs = list(config.get("rules") or [])
+            if config.get("defaults", True):
+                specs += DEFAULT_RULES
+            self.compile(specs)
+            print(f"[Rules] Loaded {len(self.rules)} rules from {self.path}")
+        except (OSError, ValueError, AttributeError) as e:
+            # Half-saved or broken file: keep what we had
+            print(f"[Rules] {self.path}: {e}")
+
+    def reload_if_changed(self, now=None, interval=1.0):
+        now = time.monotonic() if now is None else now
+        if now - self.checked_at >= interval:
+            self.checked_at = now
+            self.reload()
+
+    def match(self, node):
+        # The rule for a pw-dump node object, None if no rule applies
+        node_id = node.get('id')
+        if node_id in self.cache:
+            return self.cache[node_id]
+        props = (node.get('info') or {}).get('props') or {}
+        bits = (1 << len(self.rules)) - 1
+        for key, free in self.free.items():
+            value = props.get(key)
+            hits = free
+            if value is not None:
+                value = str(value)
+                hits |= self.exact[key].get(value.casefold(), 0)
+                for regex, bit in self.patterns[key]:
+                    if bits & bit and regex.search(value):
+                        hits |= bit
+            bits &= hits
+            if not bits:
+                break
+        rule = self.rules[(bits & -bits).bit_length() - 1] if bits else None
+        self.cache[node_id] = rule
+        return rule
+
+    def forget(self, node_id):
+        self.cache.pop(node_id, None)
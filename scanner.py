@@ -1,47 +1,291 @@
-import subprocess
-import json
+#!/usr/bin/env python3
+# ==============================================================================
+# === PIPEWIRE DIAGNOSTIC SCANNER ===
+# ==============================================================================
+#   scanner.py                 print the running nodes every 3 s
+#   scanner.py record          flight recorder: log audio nodes, clock settings
+#                              and the switcher's decisions until stopped
+#   scanner.py query --at 21:14
+#                              what was running and what rate was forced then
+#   scanner.py query --switches --since 1d
+#                              every rate switch of the last day
+#
+# The recorder log format is described in flightlog.py.
+
+import argparse
+import sys
+import threading
 import time
+from datetime import datetime, timedelta
+
+import flightlog
+from control import ControlClient
+from pwcli import format_from_params
+from pwdump import dump_nodes
+from pwgraph import NodeTable, GraphWatcher
+from pwmeta import MetadataWriter
+
+
+def scan():
+    print("--- PipeWire Diagnostic Scanner ---")
+    print("Play some audio now. Scanning for active streams...\n")
+
+    while True:
+        try:
+            # Dump the current PipeWire graph, keeping only running Nodes
+            # (apps and devices). Everything else is skipped while parsing.
+            found_something = False
+
+            for obj in dump_nodes(states=("running",)):
+                props = obj.get('info', {}).get('props', {})
+                name = props.get('node.name', 'Unknown')
+                media_class = props.get('media.class', 'No Class')
+                rate = props.get('audio.rate', 'No Rate')
+
+                print(f"[ACTIVE NODE FOUND]")
+                print(f"  Name:  {name}")
+                print(f"  Class: {media_class}")
+                print(f"  Rate:  {rate}")
+                print(f"  ID:    {obj.get('id')}")
+                print("-" * 30)
+                found_something = True
+
+            if not found_something:
+                print("No 'running' nodes found. Is music definitely playing?")
+
+            print("\nScanning again in 3 seconds... (Ctrl+C to stop)\n")
+            time.sleep(3)
+
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            print(f"Error: {e}")
+            time.sleep(3)
+
+
+# ==============================================================================
+# === RECORDER ===
+# ==============================================================================
+
+def node_fields(graph, node):
+    info = node.get('info') or {}
+    props = info.get('props') or {}
+    fields = {name: props[name] for name in flightlog.NODE_FIELDS if props.get(name) is not None}
+    if info.get('state'):
+        fields['state'] = info['state']
+    found = format_from_params(info)
+    if found:
+        fields['format'] = f"{found[0]} {found[1]}"
+    if props.get('media.class', '').startswith("Stream/"):
+        driver = graph.resolve_driver(node['id'])
+        if driver is not None:
+            fields['driver'] = driver
+    return fields
+
+
+def decision_fields(event, state):
+    fields = {name: state.get(name) for name in ("mode", "rate", "app", "format", "status")
+              if state.get(name) is not None}
+    fields['event'] = event
+    if state.get('sinks'):
+        fields['sinks'] = ", ".join(f"{name}={rate}" for name, rate in sorted(state['sinks'].items()))
+    if state.get('locks'):
+        fields['locks'] = ", ".join(f"{name}={lock['status']}" for name, lock in sorted(state['locks'].items()))
+    return fields
+
+
+def follow_switcher(log):
+    # Decisions come from a running switcher's control socket, when there is one
+    while True:
+        closed = threading.Event()
+        def on_event(event, state):
+            if event == "closed":
+                closed.set()
+            else:
+                log.update_decision(decision_fields(event, state))
+        try:
+            ControlClient().add_listener(on_event)
+            print("[Recorder] Following the switcher")
+            closed.wait()
+            print("[Recorder] Switcher gone")
+        except OSError:
+            pass
+        time.sleep(10)
+
+
+def record(args):
+    graph = NodeTable()
+    changed = threading.Event()
+    watcher = GraphWatcher(graph, on_change=lambda changes: changed.set())
+    log = flightlog.FlightLog(args.dir, max_bytes=int(args.max_size * (1 << 20)), max_segments=args.segments)
+
+    def on_setting(key, value):
+        # Straight from the monitor: a write held for half a second still
+        # gets both of its records, with the time it happened
+        if key in flightlog.CLOCK_FIELDS:
+            try:
+                log.update_clock({key: metadata.get(key) for key in flightlog.CLOCK_FIELDS})
+            except Exception as e:
+                print(f"[Recorder] {e}")
+    metadata = MetadataWriter("settings", on_change=on_setting) # Only read, never written here
+    watcher.start()
+    metadata.start()
+    threading.Thread(target=follow_switcher, args=(log,), daemon=True).start()
+    print(f"[Recorder] Writing to {log.directory} (Ctrl+C to stop)")
 
-print("--- PipeWire Diagnostic Scanner ---")
-print("Play some audio now. Scanning for active streams...\n")
+    while True:
+        try:
+            changed.wait(timeout=1.0)
+            changed.clear()
+            nodes = {node['id']: node_fields(graph, node) for node in graph.select(media_class="Audio")}
+            log.update_nodes(nodes)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            # An intermittent problem is exactly what is being recorded: keep going
+            print(f"[Recorder] {e}")
+            time.sleep(1)
 
-while True:
+    watcher.stop()
+    metadata.stop()
+    log.close()
+
+
+# ==============================================================================
+# === QUERIES ===
+# ==============================================================================
+
+def parse_time(text):
+    # "21:14" (the last one), "2026-10-18 21:14[:05]", or a unix time
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    now = datetime.now()
+    for layout in ("%H:%M", "%H:%M:%S"):
+        try:
+            clock = datetime.strptime(text, layout).time()
+        except ValueError:
+            continue
+        when = datetime.combine(now.date(), clock)
+        if when > now:
+            when -= timedelta(days=1)
+        return when.timestamp()
+    for layout in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(text, layout).timestamp()
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"not a time: {text}")
+
+
+def parse_duration(text):
+    # "90s", "30m", "3h", "1d"
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
     try:
-        # Dump the current PipeWire graph
-        result = subprocess.run(['pw-dump'], capture_output=True, text=True)
-        data = json.loads(result.stdout)
-        
-        found_something = False
-
-        for obj in data:
-            # We are looking for Nodes (apps and devices)
-            if obj.get('type') == 'PipeWire:Interface:Node':
-                info = obj.get('info', {})
-                props = info.get('props', {})
-                state = info.get('state')
-                
-                # Check if it is running (playing audio)
-                if state == "running":
-                    name = props.get('node.name', 'Unknown')
-                    media_class = props.get('media.class', 'No Class')
-                    rate = props.get('audio.rate', 'No Rate')
-                    
-                    print(f"[ACTIVE NODE FOUND]")
-                    print(f"  Name:  {name}")
-                    print(f"  Class: {media_class}")
-                    print(f"  Rate:  {rate}")
-                    print(f"  ID:    {obj.get('id')}")
-                    print("-" * 30)
-                    found_something = True
-
-        if not found_something:
-            print("No 'running' nodes found. Is music definitely playing?")
-        
-        print("\nScanning again in 3 seconds... (Ctrl+C to stop)\n")
-        time.sleep(3)
-
-    except KeyboardInterrupt:
-        break
-    except Exception as e:
-        print(f"Error: {e}")
-        break
+        if text[-1:] in units:
+            return float(text[:-1]) * units[text[-1]]
+        return float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a duration: {text}")
+
+
+def stamp(when):
+    return datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def streams(snapshot):
+    # "Firefox 48000 F32LE -> alsa_output.usb-DAC" for every running output stream
+    lines = []
+    for node_id, fields in sorted(snapshot.nodes.items()):
+        if fields.get('state') != "running" or not fields.get('media.class', '').startswith("Stream/Output"):
+            continue
+        name = fields.get('application.name') or fields.get('node.name') or str(node_id)
+        rate = fields.get('audio.rate') or fields.get('format') or "?"
+        driver = snapshot.nodes.get(int(fields['driver']), {}) if fields.get('driver') else {}
+        sink = driver.get('node.description') or driver.get('node.name')
+        fmt = fields.get('audio.format', "")
+        lines.append(f"{name} {rate} {fmt}".rstrip() + (f" -> {sink}" if sink else ""))
+    return lines
+
+
+def query_at(directory, when):
+    snapshot = flightlog.state_at(directory, when)
+    if snapshot is None:
+        print(f"Nothing recorded at {stamp(when)}")
+        return 1
+    clock = snapshot.clock
+    print(f"At {stamp(when)} (last record {stamp(snapshot.time)}):")
+    print(f"  Forced rate:    {clock.get('clock.force-rate', '0')} Hz, "
+          f"quantum {clock.get('clock.force-quantum', '0')}")
+    if snapshot.decision:
+        d = snapshot.decision
+        print(f"  Switcher:       {d.get('mode', '?')} mode, {d.get('status', '?')}"
+              + (f", {d['app']} at {d['rate']} Hz" if d.get('app') and d.get('rate') else ""))
+        if d.get('sinks'):
+            print(f"  Per sink:       {d['sinks']}")
+        if d.get('locks'):
+            print(f"  Locks:          {d['locks']}")
+    running = streams(snapshot)
+    print("  Running streams:" + ("" if running else " none"))
+    for line in running:
+        print(f"    {line}")
+    return 0
+
+
+def query_switches(directory, start, end):
+    found = 0
+    for when, kind, node_id, before, snapshot in flightlog.events(directory, start, end):
+        if kind == flightlog.CLOCK:
+            old, new = before.get('clock.force-rate', "0"), snapshot.clock.get('clock.force-rate', "0")
+            if old == new:
+                continue
+            what = f"clock.force-rate {old} -> {new}"
+        elif kind == flightlog.DECISION:
+            old, new = before.get('sinks'), snapshot.decision.get('sinks')
+            locks = snapshot.decision.get('locks') or ""
+            if old != new:
+                what = f"sinks {new or 'released'}"
+            elif "rejected" in locks and "rejected" not in (before.get('locks') or ""):
+                what = f"rejected: {locks}"
+            else:
+                continue
+        else:
+            continue
+        found += 1
+        running = streams(snapshot)
+        print(f"{stamp(when)}  {what}" + (f"  [{'; '.join(running)}]" if running else ""))
+    if not found:
+        print(f"No switches between {stamp(start)} and {stamp(end)}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PipeWire diagnostic scanner and flight recorder")
+    parser.add_argument("--dir", default=flightlog.log_dir(), help="Flight log directory")
+    commands = parser.add_subparsers(dest="command")
+    rec = commands.add_parser("record", help="Record the graph and the switcher's decisions")
+    rec.add_argument("--max-size", type=float, default=8, help="MB per log segment")
+    rec.add_argument("--segments", type=int, default=8, help="Segments to keep")
+    query = commands.add_parser("query", help="Look things up in the flight log")
+    query.add_argument("--at", type=parse_time, help="State at this time (21:14, 2026-10-18 21:14)")
+    query.add_argument("--switches", action="store_true", help="List the rate switches")
+    query.add_argument("--since", type=parse_duration, default=86400.0, help="How far back (90s, 30m, 3h, 1d)")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args)
+    elif args.command == "query":
+        if args.at is not None:
+            return query_at(args.dir, args.at)
+        if args.switches:
+            now = time.time()
+            return query_switches(args.dir, now - args.since, now)
+        query.error("give --at or --switches")
+    else:
+        scan()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+# ==============================================================================
+# === SWITCH SCHEDULER ===
+# ==============================================================================
+# Sits between stream detection and apply_rate. Every clock.force-rate change
+# makes the DAC re-lock and drop audio, so:
+#   - one stream wins, deterministically: the one we are already following
+#     while it keeps playing, otherwise the oldest (lowest object.serial).
+#     A stream with a higher priority (a "prefer" rule) beats both
+#   - a new target must stay the same for a short coalescing window before it
+#     is applied, so a burst of graph updates causes one switch, not several
+#   - crossing rate families (44.1k <-> 48k) is only allowed once the clock
+#     has stayed in its family for a minimum dwell time
+#   - the clock is held through gaps between tracks for idle_hold seconds
+# Targets that got replaced before they were applied are counted as suppressed.
+
+from metrics import METRICS
+
+APPLIED = METRICS.counter("switches_applied_total", "Rate targets applied by the schedulers")
+SUPPRESSED = METRICS.counter("switches_suppressed_total", "Rate targets replaced before they were applied")
+
+
+def rate_family(rate):
+    rate = int(rate)
+    if rate % 11025 == 0: return "44.1k"
+    if rate % 8000 == 0: return "48k"
+    return "other"
+
+
+class SwitchScheduler:
+    def __init__(self, coalesce=0.2, family_dwell=3.0, idle_hold=4.5):
+        self.coalesce = coalesce
+        self.family_dwell = family_dwell
+        self.idle_hold = idle_hold
+        self.reset()
+        self.applied = 0
+        self.suppressed = 0
+
+    def reset(self):
+        # Forget what was applied, the next target goes out right away
+        self.current = None       # (rate, quantum) last applied
+        self.holder = None        # Stream self.current was applied for, as last seen
+        self.winner_id = None
+        self.pending = None       # (rate, quantum) waiting out its window
+        self.pending_since = 0.0
+        self.switched_at = None   # When self.current was applied
+        self.idle_since = None
+        self.wake_at = None
+
+    def pick(self, streams):
+        # streams: dicts with id, serial, rate, quantum, priority (+ whatever the UI wants)
+        top = max((s.get('priority', 0) for s in streams), default=0)
+        for s in streams:
+            if s['id'] == self.winner_id and s.get('priority', 0) >= top:
+                return s
+        return min(streams, key=lambda s: (-s.get('priority', 0), s.get('serial', s['id']), s['id']), default=None)
+
+    def update(self, streams, now):
+        # Returns ("apply", winner), ("idle", None) or (None, winner/None).
+        # self.wake_at is when update() wants to be called again, if ever.
+        self.wake_at = None
+        winner = self.pick(streams)
+
+        if winner is None:
+            self._drop_pending()
+            self.winner_id = None
+            if self.current is None:
+                return None, None
+            if self.idle_since is None:
+                self.idle_since = now
+            if now - self.idle_since < self.idle_hold:
+                self.wake_at = self.idle_since + self.idle_hold
+                return None, None
+            self.current = None
+            self.holder = None
+            self.idle_since = None
+            return "idle", None
+
+        self.idle_since = None
+        self.winner_id = winner['id']
+        target = (str(winner['rate']), winner.get('quantum', 0))
+        if target == self.current:
+            self._drop_pending()
+            self.holder = winner
+            return None, winner
+
+        if target != self.pending:
+            self._drop_pending()
+            self.pending = target
+            self.pending_since = now
+
+        ready_at = self.pending_since + self.coalesce
+        if (self.current is not None and self.switched_at is not None
+                and rate_family(target[0]) != rate_family(self.current[0])):
+            ready_at = max(ready_at, self.switched_at + self.family_dwell)
+
+        if now < ready_at:
+            self.wake_at = ready_at
+            return None, winner
+
+        self.current = target
+        self.holder = winner
+        self.pending = None
+        self.switched_at = now
+        self.applied += 1
+        APPLIED.inc()
+        return "apply", winner
+
+    def _drop_pending(self):
+        if self.pending is not None:
+            self.suppressed += 1
+            SUPPRESSED.inc()
+            self.pending = None
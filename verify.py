@@ -0,0 +1,117 @@
+# ==============================================================================
+# === SWITCH VERIFICATION ===
+# ==============================================================================
+# A clock write only asks PipeWire for a rate. Whether the driver actually
+# moved shows up later: in the sink's negotiated Format (pw-dump / native
+# param events) and in pw-top's RATE / QUANT columns. Every switch becomes a
+# transaction per driver:
+#
+#   pending   written, nothing confirmed yet
+#   locked    the driver reported the rate (and the forced quantum)
+#   rejected  the driver kept reporting something else after every retry
+#   unverified  nothing reported the driver's rate at all before the deadline
+#
+# A driver that reports a different rate past the deadline gets the write
+# repeated, with the deadline growing by `backoff` each time.
+
+from metrics import METRICS
+
+TIME_TO_LOCK = METRICS.histogram("time_to_lock_seconds", "From a clock write to the driver reporting the rate",
+                                 labels=("device",))
+RETRIES = METRICS.counter("switch_retries_total", "Clock writes repeated because the driver did not follow")
+REJECTED = METRICS.counter("switches_rejected_total", "Switches the driver never followed")
+
+
+class SwitchTransaction:
+    def __init__(self, driver, rate, quantum, now, deadline):
+        self.driver = driver
+        self.rate = int(rate)
+        self.quantum = int(quantum)
+        self.started = now
+        self.deadline = now + deadline
+        self.attempts = 1
+        self.status = "pending"
+        self.seen = None        # (rate, quantum) last reported by the driver
+        self.lock_time = None   # Seconds from the first write to the lock
+
+    def matches(self, rate, quantum):
+        if rate != self.rate:
+            return False
+        # Quantum 0 leaves it to PipeWire, anything goes
+        return not self.quantum or quantum is None or quantum == self.quantum
+
+
+class SwitchVerifier:
+    def __init__(self, deadline=1.5, retries=2, backoff=2.0):
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.transactions = {} # Driver id -> SwitchTransaction
+        self.wake_at = None
+
+    def begin(self, driver, rate, quantum, now):
+        tx = self.transactions.get(driver)
+        if tx and tx.rate == int(rate) and tx.quantum == int(quantum) and tx.status != "rejected":
+            return tx # Same target, already being watched (or locked)
+        tx = self.transactions[driver] = SwitchTransaction(driver, rate, quantum, now, self.deadline)
+        self._schedule()
+        return tx
+
+    def cancel(self, driver=None):
+        if driver is None:
+            self.transactions.clear()
+        else:
+            self.transactions.pop(driver, None)
+        self._schedule()
+
+    def observe(self, driver, rate, quantum, now, name=""):
+        # The driver reported (rate, quantum), quantum None when unknown.
+        # Returns the transaction if it just locked.
+        tx = self.transactions.get(driver)
+        if tx is None or rate is None:
+            return None
+        tx.seen = (int(rate), quantum)
+        if tx.status in ("pending", "unverified") and tx.matches(int(rate), quantum):
+            tx.status = "locked"
+            tx.lock_time = now - tx.started
+            TIME_TO_LOCK.observe(tx.lock_time, device=name or str(driver))
+            self._schedule()
+            return tx
+        if tx.status == "locked" and not tx.matches(int(rate), quantum):
+            # Moved away again (another client, a device reset): watch again
+            tx.status = "pending"
+            tx.started = now
+            tx.deadline = now + self.deadline
+            tx.attempts = 1
+            self._schedule()
+        return None
+
+    def check(self, now):
+        # Expired transactions: returns [(tx, action)], action "retry" for a
+        # write to repeat, or the final "rejected" / "unverified"
+        actions = []
+        for tx in list(self.transactions.values()):
+            if tx.status != "pending" or now < tx.deadline:
+                continue
+            if tx.seen is None:
+                tx.status = "unverified"
+                actions.append((tx, tx.status))
+            elif tx.attempts > self.retries:
+                tx.status = "rejected"
+                REJECTED.inc()
+                actions.append((tx, tx.status))
+            else:
+                tx.attempts += 1
+                tx.deadline = now + self.deadline * self.backoff ** (tx.attempts - 1)
+                RETRIES.inc()
+                actions.append((tx, "retry"))
+        self._schedule()
+        return actions
+
+    def status(self, driver):
+        tx = self.transactions.get(driver)
+        return tx.status if tx else None
+
+    def _schedule(self):
+        pending = [tx.deadline for tx in self.transactions.values() if tx.status == "pending"]
+        self.wake_at = min(pending) if pending else None
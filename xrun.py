@@ -0,0 +1,193 @@
+# ==============================================================================
+# === XRUN MONITOR / ADAPTIVE QUANTUM ===
+# ==============================================================================
+# Strict mode forces the stream's own quantum, which is the lowest latency the
+# file asks for but not always what the hardware can keep up with. While a
+# clock is held this reads the driver profiler feed through `pw-top -b`:
+#
+#   S   ID  QUANT   RATE    WAIT    BUSY   W/Q   B/Q  ERR FORMAT           NAME
+#   R   40   1024  96000  20.1us  30.2us  0.01  0.03    0    S24LE 2 96000 alsa_output.usb-DAC
+#   R   50   1024  96000  10.0us   5.1us  0.00  0.01    0    S24LE 2 96000  + Strawberry
+#
+# Rows without "+" are drivers, the "+" rows below them their followers.
+# ERR is the running xrun count, B/Q how much of the cycle was spent busy.
+#
+# QuantumController turns that into one extra doubling of the forced quantum
+# per driver whenever xruns or near-deadline cycles show up, and takes one
+# back after a stable period, so strict mode ends up on the smallest quantum
+# that runs clean on this machine.
+
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+
+from metrics import METRICS, spawn
+
+XRUNS = METRICS.counter("xruns_total", "Driver xruns seen in the profiler feed")
+QUANTUM_STEPS = METRICS.counter("quantum_steps_total", "Adaptive quantum changes", labels=("direction",))
+
+MAX_QUANTUM = 8192
+MAX_STEPS = 8 # 32 -> 8192
+
+_ROW = re.compile(r"^\s*([A-Z])\s+(\d+)\s+(\d+)\s+(\d+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\d+)\s?(.*)$")
+
+
+def parse_top_line(line):
+    # One pw-top row -> dict, None for headers and anything else
+    m = _ROW.match(line)
+    if not m:
+        return None
+    rest = m.group(10)
+    try: busy = float(m.group(8))
+    except ValueError: busy = 0.0
+    return {
+        'id': int(m.group(2)),
+        'quantum': int(m.group(3)),
+        'rate': int(m.group(4)),
+        'busy': busy,
+        'errors': int(m.group(9)),
+        'follower': bool(re.search(r"(^|\s)\+ ", rest)),
+    }
+
+
+def driver_samples(rows):
+    # Folds followers into their driver:
+    # {driver id: (errors, worst B/Q, driver rate, driver quantum)}
+    samples = {}
+    driver = None
+    for row in rows:
+        if not row['follower']:
+            driver = row['id']
+            samples[driver] = (row['errors'], row['busy'], row['rate'], row['quantum'])
+        elif driver is not None:
+            errors, busy, rate, quantum = samples[driver]
+            samples[driver] = (errors + row['errors'], max(busy, row['busy']), rate, quantum)
+    return samples
+
+
+class QuantumController:
+    def __init__(self, near_deadline=0.85, stable_for=30.0, cooldown=2.0, window=60.0):
+        self.near_deadline = near_deadline # B/Q above this counts as trouble
+        self.stable_for = stable_for       # Clean seconds before one step comes back
+        self.cooldown = cooldown           # Let a raise take effect before the next one
+        self.window = window               # For the xruns/min figure
+        self.lock = threading.Lock()
+        self.steps = {}      # Driver id -> extra doublings on top of the stream's quantum
+        self.errors = {}     # Driver id -> last ERR count
+        self.calm_since = {} # Driver id -> last trouble or change
+        self.xruns = deque() # Timestamps of xruns, all drivers
+
+    def feed(self, driver, errors, busy, now, adapt=True):
+        # Returns "raised", "lowered" or None
+        with self.lock:
+            last = self.errors.get(driver)
+            self.errors[driver] = errors
+            new = errors - last if last is not None and errors >= last else 0
+            for _ in range(min(new, 1000)):
+                self.xruns.append(now)
+            if new:
+                XRUNS.inc(new)
+
+            calm_since = self.calm_since.setdefault(driver, now)
+            if not adapt:
+                return None
+            steps = self.steps.get(driver, 0)
+            if new or busy >= self.near_deadline:
+                if (now - calm_since < self.cooldown and steps) or steps >= MAX_STEPS:
+                    return None
+                self.calm_since[driver] = now
+                self.steps[driver] = steps + 1
+                QUANTUM_STEPS.inc(direction="up")
+                return "raised"
+            if steps and busy < self.near_deadline / 2 and now - calm_since >= self.stable_for:
+                self.calm_since[driver] = now
+                self.steps[driver] = steps - 1
+                QUANTUM_STEPS.inc(direction="down")
+                return "lowered"
+            return None
+
+    def target(self, driver, quantum):
+        # The quantum to force on `driver` for a stream that asks for `quantum`
+        if not quantum:
+            return quantum
+        with self.lock:
+            steps = self.steps.get(driver, 0)
+        while steps and quantum < MAX_QUANTUM:
+            quantum *= 2
+            steps -= 1
+        return quantum
+
+    def xrun_rate(self, now):
+        with self.lock:
+            while self.xruns and self.xruns[0] < now - self.window:
+                self.xruns.popleft()
+            return len(self.xruns) * 60.0 / self.window
+
+    def forget(self, driver):
+        # The driver node is gone. PipeWire reuses ids, a new node must not
+        # inherit its steps or error count
+        with self.lock:
+            self.steps.pop(driver, None)
+            self.errors.pop(driver, None)
+            self.calm_since.pop(driver, None)
+
+
+class XrunMonitor:
+    # Keeps `pw-top -b` running while set_active(True), on_sample(samples)
+    # gets {driver id: (errors, busy, rate, quantum)} once per refresh.
+
+    def __init__(self, on_sample):
+        self.on_sample = on_sample
+        self.process = None
+        self.available = True
+        self.closed = False
+        self.started_at = 0.0
+
+    def set_active(self, active):
+        if active and self.process is None and self.available and not self.closed:
+            try:
+                with spawn("pw-top"):
+                    self.process = subprocess.Popen(["pw-top", "-b"], stdout=subprocess.PIPE,
+                                                    stderr=subprocess.DEVNULL, text=True)
+            except OSError as e:
+                print(f"[Xrun] pw-top not usable ({e}), no xrun data")
+                self.available = False
+                return
+            self.started_at = time.monotonic()
+            threading.Thread(target=self._read_loop, args=(self.process,), daemon=True).start()
+        elif not active and self.process is not None:
+            self.stop()
+
+    def stop(self):
+        proc, self.process = self.process, None
+        if proc and proc.poll() is None:
+            proc.terminate()
+
+    def close(self):
+        # For good: a monitor pass still in flight can't start it again
+        self.closed = True
+        self.stop()
+
+    def _read_loop(self, proc):
+        rows = []
+        for line in proc.stdout:
+            if line.lstrip().startswith("S ") and "QUANT" in line:
+                # Header: the previous refresh is complete
+                if rows:
+                    self.on_sample(driver_samples(rows))
+                rows = []
+                continue
+            row = parse_top_line(line)
+            if row:
+                rows.append(row)
+        if rows:
+            self.on_sample(driver_samples(rows))
+        if self.process is proc:
+            # Died on its own: the next set_active restarts it, unless it
+            # can't even stay up (no profiler module, old pw-top)
+            if time.monotonic() - self.started_at < 5:
+                print("[Xrun] pw-top exited right away, no xrun data")
+                self.available = False
+            self.process = None